@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Custom decoder execution for shims with "Run Decoder in Separate Process" set.  This module is
+# loaded by the decoder pool's worker processes, so it must not import indigo or plugin.py.
+
+import importlib.util
+import json
+import os
+import sys
+
+# (device id, decoder file) -> decoder instance, one per device as in the plugin process
+decoders = {}
+
+
+def load_decoder(deviceID: int, decoder_file: str):
+    if not (decoder := decoders.get((deviceID, decoder_file))):
+        decoder_name = os.path.basename(decoder_file).split('.')[0]
+        decoder_spec = importlib.util.spec_from_file_location(decoder_name, decoder_file)
+        module = importlib.util.module_from_spec(decoder_spec)
+        sys.modules[decoder_name] = module
+        decoder_spec.loader.exec_module(module)
+        decoder_class = getattr(module, decoder_name)
+        decoder = decoders[(deviceID, decoder_file)] = decoder_class(decoder_class.__name__)
+    return decoder
+
+
+# JSON payloads arrive as the raw message bytes and are parsed here, off the plugin's message thread;
+# anything else (struct payloads) arrives already unpacked.
+def decode(deviceID: int, decoder_file: str, payload, parse_json: bool):
+    if parse_json:
+        try:
+            payload = json.loads(payload)
+        except (ValueError, TypeError):
+            payload = None
+    return load_decoder(deviceID, decoder_file).decode(payload)
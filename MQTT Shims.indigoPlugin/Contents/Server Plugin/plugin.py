@@ -4,17 +4,41 @@
 
 from __future__ import annotations
 
+import __future__
+import ast
+import copy
+import cProfile
+import functools
+import inspect
+import heapq
 import importlib.util
+import io
+import pstats
 import sys
 import os
 import shutil
 import logging
+import logging.handlers
 import json
-import yaml
-import pystache
-from queue import Queue
+import multiprocessing
+import queue
+import struct
+import textwrap
+import threading
+import time
+from array import array
+from collections import deque
 from typing import Any, Optional
-from rgbxy import Converter, GamutA, GamutB, GamutC
+
+import decoder_worker
+
+# NumPy is optional, and only imported for the first batch with enough readings to use it.  Without it
+# there's nothing to gain from batching, so value sensors are written as each message is handled.
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+
+# paho-mqtt is only imported by DirectMQTT, so plugin start doesn't pay for it unless direct mode is on.
+# Without it everything goes through the MQTT Connector.
+PAHO_AVAILABLE = importlib.util.find_spec("paho") is not None
 
 kCurDevVersCount = 0  # current version of plugin devices
 
@@ -26,6 +50,1020 @@ def safeKey(key: str) -> str:
         return key
 
 
+# Payloads reach update() as text, decoded from UTF-8 (by the MQTT Connector, or in direct mode with
+# surrogateescape so that undecodable bytes survive).  This is the inverse, for the binary payload types.
+def payload_bytes(payload: Any) -> Any:
+    if isinstance(payload, str):
+        return payload.encode('utf-8', 'surrogateescape')
+    return payload
+
+
+# yaml, pystache and rgbxy are imported on first use rather than at load, since most shim setups
+# never need some of them and plugin start shouldn't pay for it.
+def render_template(template: str, context: dict) -> str:
+    import pystache
+    return pystache.render(template, context)
+
+
+def hue_converter(space: str) -> Any:
+    from rgbxy import Converter, GamutA, GamutB, GamutC
+    return Converter({"HueB": GamutB, "HueC": GamutC}.get(space, GamutA))    # GamutA is the default
+
+
+# Parse an MQTT-style topic pattern into (kind, value) levels.  "+" matches one level and "#" the rest of
+# the topic; either can be followed by a capture name, as in "tele/+site/+uid/SENSOR".
+def parse_topic_pattern(pattern: str) -> list[tuple[str, str]]:
+    levels = []
+    parts = pattern.strip().split('/')
+    for index, part in enumerate(parts):
+        if part.startswith('#'):
+            if index != len(parts) - 1:
+                raise ValueError("'#' must be the last level of a topic pattern")
+            levels.append(('#', part[1:]))
+        elif part.startswith('+'):
+            levels.append(('+', part[1:]))
+        elif '+' in part or '#' in part:
+            raise ValueError(f"wildcards must take up a whole topic level: '{part}'")
+        else:
+            levels.append(('', part))
+    return levels
+
+
+# Match a topic against parsed pattern levels.  Returns the named captures, or None if it doesn't match.
+def match_topic_pattern(levels: list[tuple[str, str]], topic_parts: list[str]) -> Optional[dict[str, str]]:
+    captures = {}
+    for index, (kind, value) in enumerate(levels):
+        if kind == '#':
+            if value:
+                captures[value] = '/'.join(topic_parts[index:])
+            return captures
+        if index >= len(topic_parts):
+            return None
+        if kind == '+':
+            if value:
+                captures[value] = topic_parts[index]
+        elif topic_parts[index] != value:
+            return None
+    return captures if len(topic_parts) == len(levels) else None
+
+
+# The device UID from a pattern's captures: the "uid" capture if there is one, otherwise all the named
+# captures in topic order joined with '/'.
+def topic_pattern_uid(captures: dict[str, str]) -> str:
+    if 'uid' in captures:
+        return captures['uid']
+    return '/'.join(captures.values())
+
+
+# MQTT subscription filters for direct mode: a topic pattern with its captures turned back into plain
+# wildcards, or an MQTT Connector trigger match_list ("Match: x" is a literal level, "Any: " any one
+# level, "End: " the end of the topic; anything else, or no "End: ", leaves the rest open).
+def pattern_filter(levels: list[tuple[str, str]]) -> str:
+    return '/'.join(kind if kind else value for kind, value in levels)
+
+
+def match_list_filter(match_list: Any) -> Optional[str]:
+    if isinstance(match_list, str):
+        match_list = json.loads(match_list)
+    parts = []
+    for item in match_list:
+        kind, _, value = str(item).partition(':')
+        kind, value = kind.strip(), value.strip()
+        if kind == "Match" and value and not any(char in value for char in '+#'):
+            parts.append(value)
+        elif kind == "Any":
+            parts.append('+')
+        elif kind == "End":
+            return '/'.join(parts) if parts else None
+        else:
+            break
+    parts.append('#')
+    return '/'.join(parts)
+
+
+# All the topic patterns for one message type, merged into a trie so a topic finds its candidate devices
+# in time proportional to its depth.  Each device's pattern is inserted with its own address in place of
+# the UID captures, so a match normally yields exactly the device the message is for.
+class TopicTrie:
+
+    class Node:
+        __slots__ = ('children', 'plus', 'hash_devices', 'devices')
+
+        def __init__(self) -> None:
+            self.children: dict[str, TopicTrie.Node] = {}
+            self.plus: Optional[TopicTrie.Node] = None
+            self.hash_devices: list[int] = []
+            self.devices: list[int] = []
+
+    def __init__(self) -> None:
+        self.root = self.Node()
+        self.patterns: dict[int, tuple[list[tuple[str, str]], str]] = {}    # device id -> (levels, address)
+        self.distinct: list[list[tuple[str, str]]] = []    # the different patterns among them, unbound
+
+    @staticmethod
+    def _bind_address(levels: list[tuple[str, str]], address: str) -> list[tuple[str, str]]:
+        uid_levels = [index for index, (kind, name) in enumerate(levels) if kind == '+' and name == 'uid']
+        if not uid_levels:
+            uid_levels = [index for index, (kind, name) in enumerate(levels) if kind == '+' and name]
+        address_parts = address.strip().split('/')
+        if not uid_levels or len(address_parts) != len(uid_levels) or any(kind == '#' and name for kind, name in levels):
+            return levels    # can't bind (UID in a '#' capture, etc.); update() sorts it out
+        bound = list(levels)
+        for index, part in zip(uid_levels, address_parts):
+            bound[index] = ('', part)
+        return bound
+
+    def insert(self, deviceID: int, levels: list[tuple[str, str]], address: str) -> None:
+        self.patterns[deviceID] = (levels, address)
+        if levels not in self.distinct:
+            self.distinct.append(levels)
+        node = self.root
+        for kind, value in self._bind_address(levels, address):
+            if kind == '#':
+                node.hash_devices.append(deviceID)
+                return
+            if kind == '+':
+                if node.plus is None:
+                    node.plus = self.Node()
+                node = node.plus
+            else:
+                node = node.children.setdefault(value, self.Node())
+        node.devices.append(deviceID)
+
+    def remove(self, deviceID: int) -> None:
+        # Removal is rare (device stop), so just rebuild without the device.
+        if deviceID not in self.patterns:
+            return
+        del self.patterns[deviceID]
+        patterns = self.patterns
+        self.root = self.Node()
+        self.patterns = {}
+        self.distinct = []
+        for otherID, (levels, address) in patterns.items():
+            self.insert(otherID, levels, address)
+
+    def match(self, topic_parts: list[str]) -> list[int]:
+        matched = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            matched.extend(node.hash_devices)
+            if depth == len(topic_parts):
+                matched.extend(node.devices)
+                continue
+            if child := node.children.get(topic_parts[depth]):
+                stack.append((child, depth + 1))
+            if node.plus:
+                stack.append((node.plus, depth + 1))
+        return matched
+
+    # The UID a topic carries under the first of the patterns it fits, whether or not a device has that
+    # address.  For naming the source of messages no device was routed.
+    def uid(self, topic_parts: list[str]) -> Optional[str]:
+        for levels in self.distinct:
+            if (captures := match_topic_pattern(levels, topic_parts)) is not None:
+                return topic_pattern_uid(captures)
+        return None
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+
+# Level check for the queued log handlers, done on the calling thread so disabled messages are never
+# queued.  Records logged through a traced device's adapter carry trace=True and always pass.
+class LogLevelFilter(logging.Filter):
+
+    def __init__(self, level: int) -> None:
+        super().__init__()
+        self.level = level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.level or getattr(record, 'trace', False)
+
+
+# Folds the readings received inside a rate-limit window into one value.  Readings are held in an
+# array('d') so a busy sensor costs a fixed 8 bytes per reading, not a list of float objects.
+class WindowAccumulator:
+
+    FUNCTIONS = {
+        'last': lambda values: values[-1],
+        'mean': lambda values: sum(values) / len(values),
+        'min': min,
+        'max': max,
+        'sum': sum,
+    }
+
+    def __init__(self, interval: float, function: str, threshold: Optional[float]) -> None:
+        self.interval = interval
+        self.function = self.FUNCTIONS.get(function, self.FUNCTIONS['last'])
+        self.threshold = threshold
+        self.values = array('d')
+        self.window_start = 0.0
+        self.last_written: Optional[float] = None
+
+    # Add a reading; returns True if the window should be written now.
+    def add(self, value: float, now: float) -> bool:
+        if not self.values:
+            self.window_start = now
+        self.values.append(value)
+        if self.last_written is None:
+            return True
+        if self.threshold is not None and abs(value - self.last_written) >= self.threshold:
+            return True
+        return self.expired(now)
+
+    def expired(self, now: float) -> bool:
+        return bool(self.values) and (now - self.window_start) >= self.interval
+
+    def flush(self) -> Optional[float]:
+        if not self.values:
+            return None
+        value = self.function(self.values)
+        del self.values[:]
+        self.last_written = value
+        return value
+
+
+# Rolling statistics over the last `window` seconds of readings, capped at `capacity` samples.  Values
+# and timestamps live in fixed-size array('d') ring buffers; the mean is kept as a running sum and
+# min/max as monotonic deques of sample sequence numbers, so each add() is amortized O(1).
+class RollingStats:
+
+    def __init__(self, capacity: int, window: float) -> None:
+        self.capacity = capacity
+        self.window = window
+        self.values = array('d', bytes(8 * capacity))
+        self.times = array('d', bytes(8 * capacity))
+        self.seq = 0        # sequence number of the next sample
+        self.count = 0
+        self.total = 0.0
+        self.min_seqs: deque[int] = deque()
+        self.max_seqs: deque[int] = deque()
+
+    def _evict_oldest(self) -> None:
+        oldest = self.seq - self.count
+        self.total -= self.values[oldest % self.capacity]
+        self.count -= 1
+        if self.min_seqs and self.min_seqs[0] == oldest:
+            self.min_seqs.popleft()
+        if self.max_seqs and self.max_seqs[0] == oldest:
+            self.max_seqs.popleft()
+
+    def add(self, value: float, now: float) -> None:
+        if self.count == self.capacity:
+            self._evict_oldest()
+        index = self.seq % self.capacity
+        self.values[index] = value
+        self.times[index] = now
+        self.total += value
+        while self.min_seqs and self.values[self.min_seqs[-1] % self.capacity] >= value:
+            self.min_seqs.pop()
+        self.min_seqs.append(self.seq)
+        while self.max_seqs and self.values[self.max_seqs[-1] % self.capacity] <= value:
+            self.max_seqs.pop()
+        self.max_seqs.append(self.seq)
+        self.seq += 1
+        self.count += 1
+        while self.count > 1 and self.times[(self.seq - self.count) % self.capacity] < now - self.window:
+            self._evict_oldest()
+
+    def mean(self) -> float:
+        return self.total / self.count
+
+    def minimum(self) -> float:
+        return self.values[self.min_seqs[0] % self.capacity]
+
+    def maximum(self) -> float:
+        return self.values[self.max_seqs[0] % self.capacity]
+
+    # Change per minute between the oldest and newest readings in the window.
+    def rate(self) -> float:
+        oldest = (self.seq - self.count) % self.capacity
+        newest = (self.seq - 1) % self.capacity
+        elapsed = self.times[newest] - self.times[oldest]
+        if elapsed <= 0:
+            return 0.0
+        return 60.0 * (self.values[newest] - self.values[oldest]) / elapsed
+
+
+# A paced "refresh all" pass: status requests go out per broker at no more than `rate` per second,
+# with at most `concurrency` requests awaiting an answer at once.  A request that gets no matching
+# message within `timeout` seconds is counted as unanswered and frees its slot.
+class StatusSweep:
+
+    def __init__(self, device_ids_by_broker: dict[int, list[int]], concurrency: int, rate: float, timeout: float) -> None:
+        self.pending = {brokerID: deque(device_ids) for brokerID, device_ids in device_ids_by_broker.items()}
+        self.outstanding: dict[int, dict[int, float]] = {brokerID: {} for brokerID in device_ids_by_broker}
+        self.last_sent = {brokerID: float('-inf') for brokerID in device_ids_by_broker}
+        self.concurrency = max(concurrency, 1)
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.total = sum(len(device_ids) for device_ids in device_ids_by_broker.values())
+        self.unanswered: list[int] = []
+
+    # Send whatever the pacing allows; send(deviceID) returns False if the request couldn't be sent.
+    def step(self, now: float, send) -> None:
+        for brokerID, outstanding in self.outstanding.items():
+            for deviceID, sent in list(outstanding.items()):
+                if now - sent >= self.timeout:
+                    del outstanding[deviceID]
+                    self.unanswered.append(deviceID)
+            pending = self.pending[brokerID]
+            while pending and len(outstanding) < self.concurrency and now - self.last_sent[brokerID] >= self.interval:
+                deviceID = pending.popleft()
+                if send(deviceID):
+                    outstanding[deviceID] = now
+                    self.last_sent[brokerID] = now
+                else:
+                    self.unanswered.append(deviceID)
+
+    def answered(self, deviceID: int) -> None:
+        for outstanding in self.outstanding.values():
+            outstanding.pop(deviceID, None)
+
+    def done(self) -> bool:
+        return not any(self.pending.values()) and not any(self.outstanding.values())
+
+
+# The consumer side for one broker: its own coalesced notification set, fetch thread and counters,
+# so a slow broker only delays its own shims.  Notifications are held as a set of message types with the
+# time each was queued; one pending entry per message type is enough to trigger a full drain.
+#
+# Pending message types are served in priority class order (the highest class of any device using the
+# message type), oldest first within a class.  A message type that has waited longer than
+# starvation_limit seconds is served as if it were high priority.
+class BrokerPipeline:
+
+    PRIORITY_CLASSES = ("high", "normal", "low")
+
+    def __init__(self, brokerID: int, target, max_pending: int, starvation_limit: float) -> None:
+        self.brokerID = brokerID
+        self.max_pending = max_pending
+        self.starvation_limit = starvation_limit
+        self.device_ids: list[int] = []
+        self.routes: dict[str, list[int]] = {}          # message type -> devices without a topic pattern
+        self.tries: dict[str, TopicTrie] = {}           # message type -> devices with a topic pattern
+        self.device_priorities: dict[int, tuple[str, int]] = {}    # device id -> (message type, class rank)
+        self.priorities: dict[str, int] = {}            # message type -> class rank
+        self.pending: dict[str, float] = {}
+        self.overflowing = False        # dropping notifications since the pending set last had room
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.stats = {'received': 0, 'coalesced': 0, 'dropped': 0, 'requeued': 0, 'fetched': 0, 'preempted': 0, 'starved': 0}
+        self.class_fetched = [0] * len(self.PRIORITY_CLASSES)
+        self.thread = threading.Thread(target=target, args=(self,), name=f"BrokerPipeline-{brokerID}", daemon=True)
+
+    # Returns False for the first notification dropped because the pending set is full; the rest of an
+    # overflow are only counted, so a reconnect storm doesn't flood the log.
+    def put(self, message_type: str) -> bool:
+        with self.lock:
+            self.stats['received'] += 1
+            if message_type in self.pending:
+                self.stats['coalesced'] += 1
+                return True
+            if len(self.pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                first, self.overflowing = not self.overflowing, True
+                return not first
+            self.overflowing = False
+            self.pending[message_type] = time.monotonic()
+        self.wakeup.set()
+        return True
+
+    # A preempted message type keeps its original queue time so it still ages toward starvation_limit.
+    def requeue(self, message_type: str, queued: Optional[float] = None) -> None:
+        with self.lock:
+            self.stats['preempted' if queued else 'requeued'] += 1
+            self.pending.setdefault(message_type, queued or time.monotonic())
+        self.wakeup.set()
+
+    def _rank(self, message_type: str, queued: float, now: float) -> int:
+        if now - queued >= self.starvation_limit:
+            return 0
+        return self.priorities.get(message_type, 1)
+
+    # Remove and return the pending message type to serve next, with its class rank and queue time.
+    def next(self) -> Optional[tuple[str, int, float]]:
+        with self.lock:
+            if not self.pending:
+                return None
+            now = time.monotonic()
+            message_type = min(self.pending, key=lambda mt: (self._rank(mt, self.pending[mt], now), self.pending[mt]))
+            queued = self.pending.pop(message_type)
+            rank = self._rank(message_type, queued, now)
+            if rank < self.priorities.get(message_type, 1):
+                self.stats['starved'] += 1
+        return message_type, rank, queued
+
+    # True if something of a higher class than `rank` is waiting
+    def preempts(self, rank: int) -> bool:
+        if rank == 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            return any(self._rank(mt, queued, now) < rank for mt, queued in self.pending.items())
+
+    def _update_priority(self, message_type: str) -> None:
+        ranks = [rank for mt, rank in self.device_priorities.values() if mt == message_type]
+        if ranks:
+            self.priorities[message_type] = min(ranks)
+        else:
+            self.priorities.pop(message_type, None)
+
+    def add_device(self, deviceID: int, message_type: str, pattern: Optional[list[tuple[str, str]]], address: str, priority: str) -> None:
+        with self.lock:
+            self.device_ids.append(deviceID)
+            rank = self.PRIORITY_CLASSES.index(priority) if priority in self.PRIORITY_CLASSES else 1
+            self.device_priorities[deviceID] = (message_type, rank)
+            self._update_priority(message_type)
+            if pattern is None:
+                self.routes.setdefault(message_type, []).append(deviceID)
+            else:
+                self.tries.setdefault(message_type, TopicTrie()).insert(deviceID, pattern, address)
+
+    def remove_device(self, deviceID: int) -> None:
+        with self.lock:
+            if deviceID in self.device_ids:
+                self.device_ids.remove(deviceID)
+            if deviceID in self.device_priorities:
+                message_type, _ = self.device_priorities.pop(deviceID)
+                self._update_priority(message_type)
+            for device_ids in self.routes.values():
+                if deviceID in device_ids:
+                    device_ids.remove(deviceID)
+            for trie in self.tries.values():
+                trie.remove(deviceID)
+
+    # The UID of an unrouted message on a topic pattern message type, from the pattern captures
+    def pattern_uid(self, message_type: str, topic_parts: list[str]) -> Optional[str]:
+        with self.lock:
+            if trie := self.tries.get(message_type):
+                return trie.uid(topic_parts)
+        return None
+
+    # The devices a message should be offered to, in device start order
+    def route(self, message_type: str, topic_parts: list[str]) -> list[int]:
+        with self.lock:
+            device_ids = list(self.routes.get(message_type, ()))
+            if (trie := self.tries.get(message_type)) and (matched := trie.match(topic_parts)):
+                device_ids.extend(matched)
+                if len(device_ids) > 1:
+                    order = {deviceID: index for index, deviceID in enumerate(self.device_ids)}
+                    device_ids.sort(key=order.__getitem__)
+        return device_ids
+
+    def count_fetched(self, fetched: int, rank: int) -> None:
+        with self.lock:
+            self.stats['fetched'] += fetched
+            self.class_fetched[rank] += fetched
+
+    # Pending message types per priority class
+    def class_depths(self) -> list[int]:
+        depths = [0] * len(self.PRIORITY_CLASSES)
+        with self.lock:
+            for message_type in self.pending:
+                depths[self.priorities.get(message_type, 1)] += 1
+        return depths
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.wakeup.set()
+
+
+# This plugin's own connection to one broker, for direct mode.  The shims' topic filters are subscribed
+# under the message type their connector trigger would have given them, and received messages wait in
+# per-message-type queues that processMessages drains ahead of fetchQueuedMessage.  Only the devices
+# subscribed here get these messages; the rest of a message type's shims stay on the connector.  paho's
+# network thread reconnects (and on_connect resubscribes) if the connection drops; connection problems
+# are logged when they start and when they clear, not on every retry.
+class DirectMQTT:
+    MAX_QUEUED = 1000     # messages held per message type; the oldest is dropped beyond this
+
+    def __init__(self, brokerID: int, name: str, host: str, port: int, username: str, password: str,
+                 tls: bool, ca_certs: Optional[str], logger: logging.Logger, on_queued) -> None:
+        import paho.mqtt.client as paho_mqtt
+        self.paho = paho_mqtt
+        self.brokerID = brokerID
+        self.name = name
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.logger = logger
+        self.on_queued = on_queued      # called with the message type when a message is queued
+        self.problem: Optional[str] = None      # the last connection problem logged
+        self.stopping = False
+        self.subscriptions: dict[str, dict[int, str]] = {}     # filter -> device id -> message type
+        self.message_types: dict[str, int] = {}     # message type -> devices subscribed for it
+        self.device_ids: set[int] = set()
+        self.queues: dict[str, deque] = {}
+        self.lock = threading.Lock()
+        self.connected = False
+        self.stats = {"received": 0, "unmatched": 0, "dropped": 0, "published": 0, "discarded": 0}
+        try:
+            self.client = paho_mqtt.Client(paho_mqtt.CallbackAPIVersion.VERSION2, client_id=f"indigo-mqtt-shims-{brokerID}-{os.getpid()}")
+        except AttributeError:      # paho-mqtt 1.x
+            self.client = paho_mqtt.Client(client_id=f"indigo-mqtt-shims-{brokerID}-{os.getpid()}")
+        if username:
+            self.client.username_pw_set(username, password or None)
+        if tls:
+            self.client.tls_set(ca_certs=ca_certs or None)     # raises if the CA file can't be used
+        self.client.on_connect = self.on_connect
+        self.client.on_connect_fail = self.on_connect_fail
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+
+    def start(self) -> None:
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def describe(self) -> str:
+        return f"{self.host}:{self.port}{' (TLS)' if self.tls else ''}"
+
+    def report_problem(self, problem: str) -> None:
+        if problem != self.problem:
+            self.problem = problem
+            self.logger.error(f"{self.name}: direct connection to {self.describe()} {problem}, retrying")
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None) -> None:
+        if getattr(reason_code, "is_failure", reason_code != 0):
+            self.report_problem(f"refused: {reason_code}")
+            return
+        self.connected = True
+        self.problem = None
+        self.logger.info(f"{self.name}: connected directly to {self.describe()}")
+        with self.lock:
+            filters = list(self.subscriptions)
+        for topic_filter in filters:
+            self.client.subscribe(topic_filter)
+
+    # The broker couldn't be reached at all (wrong host or port, TLS handshake failure, ...)
+    def on_connect_fail(self, client, userdata) -> None:
+        self.report_problem("failed")
+
+    def on_disconnect(self, client, userdata, *args) -> None:
+        was_connected, self.connected = self.connected, False
+        if was_connected and not self.stopping:
+            reason = args[1] if len(args) > 1 else args[0] if args else ""      # paho 2.x: (flags, reason, properties); 1.x: (rc,)
+            self.logger.warning(f"{self.name}: direct connection to {self.describe()} lost ({reason}), shims on it are served by "
+                                f"the MQTT Connector until it reconnects")
+
+    def on_message(self, client, userdata, message) -> None:
+        message_types = set()
+        with self.lock:
+            self.stats["received"] += 1
+            for topic_filter, devices in self.subscriptions.items():
+                if self.paho.topic_matches_sub(topic_filter, message.topic):
+                    message_types.update(devices.values())
+            if not message_types:
+                self.stats["unmatched"] += 1
+                return
+            # the connector hands payloads over as text; surrogateescape keeps binary payloads recoverable
+            # by payload_bytes()
+            message_data = {'topic_parts': message.topic.split('/'),
+                            'payload': message.payload.decode('utf-8', 'surrogateescape')}
+            for message_type in message_types:
+                if not (queue := self.queues.get(message_type)):
+                    queue = self.queues[message_type] = deque(maxlen=self.MAX_QUEUED)
+                if len(queue) == self.MAX_QUEUED:
+                    self.stats["dropped"] += 1
+                queue.append(message_data)
+        for message_type in message_types:
+            self.on_queued(message_type)
+
+    def fetch(self, message_type: str) -> Optional[dict]:
+        with self.lock:
+            if queue := self.queues.get(message_type):
+                return queue.popleft()
+        return None
+
+    # Returns False when not connected, for the caller to publish through the connector instead
+    def publish(self, topic: str, payload: str) -> bool:
+        if not self.connected:
+            return False
+        self.client.publish(topic, payload, qos=0, retain=False)
+        self.stats["published"] += 1
+        return True
+
+    # Message types arriving on this connection
+    def serves(self, message_type: str) -> bool:
+        return message_type in self.message_types
+
+    # Devices getting their messages on this connection rather than from the connector
+    def serves_device(self, deviceID: int) -> bool:
+        return deviceID in self.device_ids
+
+    def add_device(self, deviceID: int, message_type: str, filters: list[str]) -> None:
+        new_filters = []
+        with self.lock:
+            self.message_types[message_type] = self.message_types.get(message_type, 0) + 1
+            self.device_ids.add(deviceID)
+            for topic_filter in filters:
+                if topic_filter not in self.subscriptions:
+                    self.subscriptions[topic_filter] = {}
+                    new_filters.append(topic_filter)
+                self.subscriptions[topic_filter][deviceID] = message_type
+        if self.connected:
+            for topic_filter in new_filters:
+                self.client.subscribe(topic_filter)
+
+    def remove_device(self, deviceID: int) -> None:
+        unused = []
+        with self.lock:
+            self.device_ids.discard(deviceID)
+            message_type = None
+            for topic_filter, devices in list(self.subscriptions.items()):
+                if (message_type := devices.pop(deviceID, None) or message_type) and not devices:
+                    del self.subscriptions[topic_filter]
+                    unused.append(topic_filter)
+            if message_type:
+                if self.message_types[message_type] > 1:
+                    self.message_types[message_type] -= 1
+                else:
+                    del self.message_types[message_type]
+                    self.queues.pop(message_type, None)
+        if self.connected:
+            for topic_filter in unused:
+                self.client.unsubscribe(topic_filter)
+
+
+# Last-seen watchdog for every device with an expected reporting interval, on a single timer heap.
+# A message only moves the device's deadline in a dict; the heap keeps one entry per device and an
+# entry that pops before the device's current deadline is pushed back at that deadline, so the heap
+# stays at one entry per watched device no matter how often they report.  A device restarted while its
+# entry is still in the heap reuses that entry rather than pushing another.
+class Watchdog:
+    LAST_SEEN_INTERVAL = 60.0       # seconds between lastSeen writes for a device that keeps reporting
+
+    def __init__(self) -> None:
+        self.heap: list[tuple[float, int]] = []
+        self.queued: dict[int, float] = {}      # device id -> deadline of its entry in the heap
+        self.deadlines: dict[int, float] = {}
+        self.intervals: dict[int, float] = {}
+        self.last_seen_written: dict[int, float] = {}
+        self.offline: set[int] = set()
+        self.lock = threading.Lock()
+
+    def arm(self, deviceID: int, interval: float, now: float) -> None:
+        with self.lock:
+            self.intervals[deviceID] = interval
+            self.deadlines[deviceID] = now + interval
+            self.offline.discard(deviceID)
+            if (queued := self.queued.get(deviceID)) is not None and queued > now + interval:
+                # the interval was shortened; replace the entry rather than let it pop late (restarts are rare)
+                self.heap.remove((queued, deviceID))
+                heapq.heapify(self.heap)
+                del self.queued[deviceID]
+            if deviceID not in self.queued:
+                # an entry still queued pops no later than the new deadline and gets pushed back to it
+                self.queued[deviceID] = now + interval
+                heapq.heappush(self.heap, (now + interval, deviceID))
+
+    def disarm(self, deviceID: int) -> None:
+        with self.lock:
+            self.intervals.pop(deviceID, None)
+            self.deadlines.pop(deviceID, None)
+            self.last_seen_written.pop(deviceID, None)
+            self.offline.discard(deviceID)
+
+    # Note a message from the device.  Returns whether the device had been marked offline, and whether
+    # its lastSeen state is due to be written.
+    def seen(self, deviceID: int, now: float) -> tuple[bool, bool]:
+        with self.lock:
+            if deviceID not in self.intervals:
+                return False, False
+            self.deadlines[deviceID] = now + self.intervals[deviceID]
+            if last_seen_due := now - self.last_seen_written.get(deviceID, -self.LAST_SEEN_INTERVAL) >= self.LAST_SEEN_INTERVAL:
+                self.last_seen_written[deviceID] = now
+            if deviceID in self.offline:
+                self.offline.discard(deviceID)
+                self.last_seen_written[deviceID] = now
+                if deviceID not in self.queued:
+                    self.queued[deviceID] = self.deadlines[deviceID]
+                    heapq.heappush(self.heap, (self.deadlines[deviceID], deviceID))
+                return True, True
+            return False, last_seen_due
+
+    # Returns (device id, missed deadline) for the devices whose deadline has passed since the last call.
+    def expired(self, now: float) -> list[tuple[int, float]]:
+        missed = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, deviceID = heapq.heappop(self.heap)
+                current = self.deadlines.get(deviceID)
+                if current is None or deviceID in self.offline:
+                    self.queued.pop(deviceID, None)
+                    continue    # disarmed, or a stale entry
+                if current > now:
+                    self.queued[deviceID] = current
+                    heapq.heappush(self.heap, (current, deviceID))
+                    continue
+                self.offline.add(deviceID)
+                self.queued.pop(deviceID, None)
+                missed.append((deviceID, current))
+        return missed
+
+
+# adjustmentFunction formulas that NumPy evaluates bit-for-bit the same as Python floats: + - * / and
+# unary minus over x and numeric constants.  Anything else (round, pow, min...) gets None and stays
+# on the scalar path.
+@functools.lru_cache(maxsize=256)
+def compile_array_formula(function: str) -> Any:
+    try:
+        tree = ast.parse(function.strip(), mode='eval')
+    except SyntaxError:
+        return None
+    uses_x = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id != 'x':
+                return None
+            uses_x = True
+        elif isinstance(node, ast.Constant):
+            if type(node.value) not in (int, float) or (type(node.value) is int and abs(node.value) > 2 ** 53):
+                return None
+        elif not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load,
+                                   ast.Add, ast.Sub, ast.Mult, ast.Div, ast.USub, ast.UAdd)):
+            return None
+    return compile(tree, '<adjustmentFunction>', 'eval') if uses_x else None     # without x the scalar result is an int
+
+
+# Value sensor readings held back until the end of a fetch pass, so each adjustmentFunction is evaluated
+# once over all its readings and the sensorValue writes go out back to back.  A device has at most one
+# reading waiting; a second message for it flushes the batch first, which keeps each device's order.
+class ValueBatch:
+
+    def __init__(self) -> None:
+        self.entries: list[tuple] = []    # (device, value, function, updated_state_keys, reported_states)
+        self.sources: list[tuple] = []    # (broker, message type, uid) of each entry's message, for TrafficStats
+        self.device_ids: set[int] = set()
+        self.flush_seconds = 0.0          # total time spent flushing
+
+    def add(self, device, value: float, function: Optional[str], updated_state_keys: set[str], reported_states: dict) -> None:
+        self.entries.append((device, value, function, updated_state_keys, reported_states))
+        self.device_ids.add(device.id)
+
+    # Note the traffic source of the entries added since the last call
+    def tag(self, source: tuple) -> None:
+        self.sources.extend([source] * (len(self.entries) - len(self.sources)))
+
+    def take(self) -> tuple[list[tuple], list[tuple]]:
+        entries, self.entries = self.entries, []
+        sources, self.sources = self.sources, []
+        self.device_ids.clear()
+        return entries, sources
+
+
+# Specializes update() for a device by partial evaluation of its source.  Every if whose test depends only
+# on device.deviceTypeId and device.pluginProps (directly, or through a local assigned once from them) is
+# decided when the function is compiled and the branch not taken is dropped, so the compiled function is
+# update() minus the steps the device can never reach.  Methods update() calls (match_uid) are specialized
+# the same way and called directly.  Compiled functions are cached by the tuple of decided test outcomes,
+# so devices whose props steer the same way share one function.  Working out that tuple means deciding
+# every if test, so it is cached per device too, until the device's props change.
+class UpdateCompiler:
+
+    class NotStatic(Exception):
+        pass
+
+    COMPARE = {ast.Eq: lambda a, b: a == b, ast.NotEq: lambda a, b: a != b,
+               ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+               ast.Is: lambda a, b: a is b, ast.IsNot: lambda a, b: a is not b}
+
+    def __init__(self, module_globals: dict, *methods) -> None:
+        self.module_globals = module_globals
+        self.functions = []     # (FunctionDef, static locals: name -> value expression)
+        self.tests = []         # (if test, static locals) for every if in the functions, in shape() order
+        self.filename = inspect.getsourcefile(methods[0])
+        for method in methods:
+            lines, first_line = inspect.getsourcelines(method)
+            function = ast.parse(textwrap.dedent(''.join(lines))).body[0]
+            ast.increment_lineno(function, first_line - 1)      # tracebacks point at the real source lines
+            names = self.static_locals(function)
+            self.functions.append((function, names))
+            self.tests.extend((node.test, names) for node in ast.walk(function) if isinstance(node, ast.If))
+        self.method_names = {function.name for function, _ in self.functions}
+        self.cache: dict[tuple, Any] = {}
+        self.shapes: dict[int, tuple[str, dict, tuple]] = {}     # device id -> (type, props, shape) it was worked out for
+
+    # Locals bound exactly once, by a plain assignment from something static
+    def static_locals(self, function: ast.FunctionDef) -> dict[str, ast.expr]:
+        bindings: dict[str, int] = {}
+        for node in ast.walk(function):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                bindings[node.id] = bindings.get(node.id, 0) + 1
+        candidates = {}
+        for node in ast.walk(function):
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                if bindings[node.targets[0].id] == 1:
+                    candidates[node.targets[0].id] = node.value
+        return candidates
+
+    def evaluate(self, node: ast.expr, device, names: dict[str, ast.expr]) -> Any:
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [self.evaluate(item, device, names) for item in node.elts]
+        if isinstance(node, ast.Name) and node.id in names:
+            return self.evaluate(names[node.id], device, names)
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'device' and node.attr == 'deviceTypeId':
+            return device.deviceTypeId
+        if isinstance(node, ast.Subscript) and self.is_props(node.value):
+            try:
+                return device.pluginProps[self.evaluate(node.slice, device, names)]
+            except KeyError:
+                raise self.NotStatic        # leave it to raise at run time, as update() would
+        if isinstance(node, ast.Call) and not node.keywords:
+            func = node.func
+            if isinstance(func, ast.Attribute) and func.attr == 'get' and self.is_props(func.value):
+                return device.pluginProps.get(*[self.evaluate(arg, device, names) for arg in node.args])
+            if isinstance(func, ast.Name) and func.id == 'bool' and len(node.args) == 1:
+                return bool(self.evaluate(node.args[0], device, names))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return not self.evaluate(node.operand, device, names)
+        if isinstance(node, ast.Compare) and all(type(op) in self.COMPARE for op in node.ops):
+            left = self.evaluate(node.left, device, names)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self.evaluate(comparator, device, names)
+                if not self.COMPARE[type(op)](left, right):
+                    return False
+                left = right
+            return True
+        if isinstance(node, ast.BoolOp):
+            values = [self.evaluate(value, device, names) for value in node.values]
+            if isinstance(node.op, ast.And):
+                return next((value for value in values if not value), values[-1])
+            return next((value for value in values if value), values[-1])
+        raise self.NotStatic
+
+    @staticmethod
+    def is_props(node: ast.expr) -> bool:
+        return (isinstance(node, ast.Attribute) and node.attr == 'pluginProps'
+                and isinstance(node.value, ast.Name) and node.value.id == 'device')
+
+    # An if test decided for this device: True/False, or None if it has to be evaluated at run time
+    def decide(self, test: ast.expr, device, names: dict[str, ast.expr]) -> Optional[bool]:
+        try:
+            return bool(self.evaluate(test, device, names))
+        except self.NotStatic:
+            pass
+        if isinstance(test, ast.BoolOp):
+            # a static operand settles the test when every operand before it is static too
+            decisive = isinstance(test.op, ast.Or)
+            for value in test.values:
+                if (decided := self.decide(value, device, names)) is None:
+                    break
+                if decided == decisive:
+                    return decisive
+        return None
+
+    # Everything the specialization depends on: each if test's decision, and for and/or tests the
+    # decisions for their operands that simplify() uses
+    def shape(self, device) -> tuple:
+        props = dict(device.pluginProps)
+        if (cached := self.shapes.get(device.id)) and cached[0] == device.deviceTypeId and cached[1] == props:
+            return cached[2]
+        shape = []
+        for test, names in self.tests:
+            shape.append(self.decide(test, device, names))
+            if isinstance(test, ast.BoolOp):
+                shape.append(tuple(self.decide(value, device, names) for value in test.values))
+        shape = (device.deviceTypeId, tuple(shape))
+        self.shapes[device.id] = (device.deviceTypeId, props, shape)
+        return shape
+
+    def forget(self, deviceID: int) -> None:
+        self.shapes.pop(deviceID, None)
+
+    def compile(self, device) -> Any:
+        shape = self.shape(device)
+        if compiled := self.cache.get(shape):
+            return compiled
+        compiler = self
+
+        class Specializer(ast.NodeTransformer):
+            def __init__(self, names: dict[str, ast.expr]) -> None:
+                self.names = names
+
+            def visit_If(self, node: ast.If) -> Any:
+                decided = compiler.decide(node.test, device, self.names)
+                if decided is None:
+                    node.test = compiler.simplify(node.test, device, self.names)
+                    self.generic_visit(node)
+                    node.body = node.body or [ast.Pass()]
+                    return node
+                statements = []
+                for statement in (node.body if decided else node.orelse):
+                    visited = self.visit(statement)
+                    statements.extend(visited if isinstance(visited, list) else [visited])
+                return statements or ast.Pass()
+
+            # self.match_uid(...) -> match_uid(self, ...), the specialized one defined alongside
+            def visit_Call(self, node: ast.Call) -> Any:
+                self.generic_visit(node)
+                func = node.func
+                if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'self' and func.attr in compiler.method_names:
+                    node.func = ast.Name(id=func.attr, ctx=ast.Load())
+                    node.args.insert(0, ast.Name(id='self', ctx=ast.Load()))
+                return node
+
+        body = []
+        for function, names in self.functions:
+            function = Specializer(names).visit(copy.deepcopy(function))
+            function.decorator_list = []
+            body.append(function)
+        module = ast.fix_missing_locations(ast.Module(body=body, type_ignores=[]))
+        code = compile(module, self.filename, 'exec', flags=__future__.annotations.compiler_flag, dont_inherit=True)
+        namespace = dict(self.module_globals)     # a copy, so the functions' names don't clobber the module's
+        exec(code, namespace)
+        compiled = self.cache[shape] = namespace[self.functions[0][0].name]
+        return compiled
+
+    # Drop the static operands of a run time and/or test that don't affect its truth value
+    def simplify(self, test: ast.expr, device, names: dict[str, ast.expr]) -> ast.expr:
+        if not isinstance(test, ast.BoolOp):
+            return test
+        neutral = isinstance(test.op, ast.And)      # True doesn't change an and, False doesn't change an or
+        values = [value for value in test.values if self.decide(value, device, names) is not neutral]
+        if not values:
+            return ast.Constant(value=neutral)
+        return values[0] if len(values) == 1 else ast.BoolOp(op=test.op, values=values)
+
+
+# Per-source traffic accounting, keyed by (broker, message type, uid).  Each fetched message is counted
+# once, as matched (some shim took it), uid mismatch (routed shims wanted other uids, or none were
+# routed), decode failure, or shim configuration error (a uid setting the shim is missing or can't use),
+# along with its payload size in bytes and the time spent handling it, deferred value sensor work included.
+class TrafficStats:
+    MISMATCH = "mismatch"
+    CONFIG = "config"
+    FAILED = "failed"
+    MATCHED = "matched"
+    RANK = {MISMATCH: 0, CONFIG: 1, FAILED: 2, MATCHED: 3}      # a message's outcome is the best over its routed shims
+    RECEIVED, MATCHED_COUNT, MISMATCHED, FAILURES, CONFIG_ERRORS, BYTES, SECONDS = range(7)
+
+    def __init__(self) -> None:
+        self.counts: dict[tuple[int, str, str], list] = {}
+        self.samples: dict[tuple[int, str, str], str] = {}     # last topic seen for each source
+        self.lock = threading.Lock()
+
+    def record(self, brokerID: int, message_type: str, uid: Optional[str], outcome: str, size: int, seconds: float, topic: str) -> None:
+        key = (brokerID, message_type, uid if uid is not None else "?")
+        with self.lock:
+            if not (counts := self.counts.get(key)):
+                counts = self.counts[key] = [0, 0, 0, 0, 0, 0, 0.0]
+            counts[self.RECEIVED] += 1
+            if outcome == self.MATCHED:
+                counts[self.MATCHED_COUNT] += 1
+            elif outcome == self.MISMATCH:
+                counts[self.MISMATCHED] += 1
+            elif outcome == self.CONFIG:
+                counts[self.CONFIG_ERRORS] += 1
+            else:
+                counts[self.FAILURES] += 1
+            counts[self.BYTES] += size
+            counts[self.SECONDS] += seconds
+            self.samples[key] = topic
+
+    # Time spent later on messages already recorded (the batched value sensor work), split evenly over them
+    def add_seconds(self, sources: list[tuple[int, str, Optional[str]]], seconds: float) -> None:
+        with self.lock:
+            for brokerID, message_type, uid in sources:
+                if counts := self.counts.get((brokerID, message_type, uid if uid is not None else "?")):
+                    counts[self.SECONDS] += seconds / len(sources)
+
+    # Sources ranked by the messages that did no useful work, then by the time they took
+    def wasteful(self, limit: int) -> list[tuple[tuple[int, str, str], list]]:
+        with self.lock:
+            items = [(key, list(counts)) for key, counts in self.counts.items()]
+        wasted = [item for item in items if item[1][self.RECEIVED] > item[1][self.MATCHED_COUNT]]
+        wasted.sort(key=lambda item: (item[1][self.RECEIVED] - item[1][self.MATCHED_COUNT], item[1][self.SECONDS]), reverse=True)
+        return wasted[:limit]
+
+    def totals_by_message_type(self) -> dict[tuple[int, str], list]:
+        totals: dict[tuple[int, str], list] = {}
+        with self.lock:
+            for (brokerID, message_type, _), counts in self.counts.items():
+                total = totals.setdefault((brokerID, message_type), [0, 0, 0, 0, 0, 0, 0.0])
+                for index, count in enumerate(counts):
+                    total[index] += count
+        return totals
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counts.clear()
+            self.samples.clear()
+
+
 ################################################################################
 class Plugin(indigo.PluginBase):
 
@@ -49,29 +1087,116 @@ class Plugin(indigo.PluginBase):
         "quantity-cm": ("0", indigo.kStateImageSel.NoImage, " cm"),
     }
 
+    # Limits on each broker's notification backlog
+    MAX_PENDING_NOTIFICATIONS = 1000    # distinct message types held at once
+    MAX_FETCH_PER_PASS = 250            # messages fetched per message type before yielding to the others
+    STARVATION_LIMIT = 5.0              # seconds before a waiting low priority message type is served as high
+    DECODER_PROCESSES = 2               # worker processes for custom decoders run out of process
+    VALUE_BATCH_ARRAY_MIN = 8           # readings sharing a formula before it's worth evaluating with NumPy
+    DECODER_WINDOW = 16                 # messages per broker waiting on decoder processes before the oldest is applied
+    DECODER_BACKOFF = 60.0              # seconds a timed-out decoder is skipped, doubling for each timeout in a row
+    DECODER_BACKOFF_MAX = 3600.0
+    WASTED_TRAFFIC_WARNING = 0.5        # share of a message type's traffic no shim wants before suggesting a tighter match_list
+
+    # default priority class for devices that haven't had one set
+    DEFAULT_PRIORITY: dict[str, str] = {
+        "shimRelay": "high",
+        "shimDimmer": "high",
+        "shimColor": "high",
+        "shimOnOffSensor": "high",
+        "shimValueSensor": "low",
+        "shimGeneric": "normal",
+    }
+
+    # rolling statistic option -> (state id, state label, RollingStats accessor)
+    ROLLING_STATS: dict[str, tuple[str, str, str]] = {
+        "mean": ("rollingMean", "Rolling Mean", "mean"),
+        "min": ("rollingMin", "Rolling Minimum", "minimum"),
+        "max": ("rollingMax", "Rolling Maximum", "maximum"),
+        "rate": ("rateOfChange", "Rate of Change (per minute)", "rate"),
+    }
+
     ########################################
     # Main Plugin methods
     ########################################
     def __init__(self, pluginId: str, pluginDisplayName: str, pluginVersion: str, pluginPrefs: indigo.Dict) -> None:
+        init_start = time.perf_counter()
         indigo.PluginBase.__init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
 
-        self.logLevel = int(pluginPrefs.get("logLevel", logging.INFO))
-        self.indigo_log_handler.setLevel(self.logLevel)
         log_format = logging.Formatter('%(asctime)s.%(msecs)03d\t[%(levelname)8s] %(name)20s.%(funcName)-25s%(msg)s',datefmt='%Y-%m-%d %H:%M:%S')
         self.plugin_file_handler.setFormatter(log_format)
-        self.plugin_file_handler.setLevel(self.logLevel)
-        self.logger.debug(f"logLevel = {self.logLevel}")
+
+        # Handler I/O (the Indigo event log and the plugin log file) runs on a background listener thread,
+        # so the message threads only pay for queueing a record.  The level check moves to logFilter.
+        self.logFilter = LogLevelFilter(logging.INFO)
+        self.logQueueHandler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        self.logQueueHandler.addFilter(self.logFilter)
+        self.logListener = logging.handlers.QueueListener(self.logQueueHandler.queue, self.indigo_log_handler, self.plugin_file_handler)
+        self.logHandlersOwner = self.logger if self.indigo_log_handler in self.logger.handlers else logging.getLogger()
+        for handler in (self.indigo_log_handler, self.plugin_file_handler):
+            handler.setLevel(logging.NOTSET)
+            self.logHandlersOwner.removeHandler(handler)
+        self.logHandlersOwner.addHandler(self.logQueueHandler)
+        self.logListener.start()
+        self.deviceLoggers: dict[int, logging.LoggerAdapter] = {}    # devices with per-device debug logging
+        self.set_log_level(int(pluginPrefs.get("logLevel", logging.INFO)))
 
         self.triggers = {}
         self.shimDevices = []
         self.decoders = {}
+        self.decoderProcessDevices: set[int] = set()      # devices whose custom decoder runs in the decoder pool
+        self.decoderPool = None
+        self.decoderPoolFailed = False
+        self.decoderPoolLock = threading.Lock()
+        self.decoderBackoff: dict[int, tuple[int, float]] = {}     # device id -> (timeouts in a row, skipped until)
         self.messageTypesWanted = []
-        self.messageQueue = Queue()
+        self.pipelines: dict[int, BrokerPipeline] = {}
+        self.directClients: dict[int, DirectMQTT] = {}
+        self.directFailed: set[int] = set()     # brokers whose direct connection couldn't be set up
+        self.pipelinesLock = threading.Lock()
+        self.accumulators: dict[tuple[int, str], WindowAccumulator] = {}
+        self.accumulatorLock = threading.Lock()
+        self.rollingStats: dict[int, RollingStats] = {}
+        self.statusSweep: Optional[StatusSweep] = None
+        self.statusSweepStartTime: Optional[float] = None
+        self.profileUntil: Optional[float] = None
+        self.profiles: list[cProfile.Profile] = []
+        self.profilesLock = threading.Lock()
+        self.profilerLock = threading.Lock()
+        self.pendingCommands: dict[int, tuple[float, dict, dict]] = {}    # device id -> (sent, expected, previous)
+        self.pendingCommandsLock = threading.Lock()
+        self.commandLatency: dict[int, list[float]] = {}    # device id -> [count, total, max] in seconds
+        self.watchdog = Watchdog()
+        self.traffic = TrafficStats()
+        self.updateFunctions: dict[int, Any] = {}     # device id -> update() specialized for its props
+        try:
+            self.updateCompiler = UpdateCompiler(globals(), Plugin.update, Plugin.match_uid)
+        except (OSError, TypeError, SyntaxError) as err:
+            self.logger.warning(f"Unable to specialize update functions, using update() for all devices: {err}")
+            self.updateCompiler = None
+        self.structLayouts: dict[int, tuple[str, str, struct.Struct, list[str]]] = {}    # device id -> (format, fields, compiled, names)
+        self.topicPatterns: dict[int, tuple[str, list[tuple[str, str]]]] = {}     # device id -> (pattern, parsed levels)
         self.mqttPlugin = indigo.server.getPlugin("com.flyingdiver.indigoplugin.mqtt")
 
-        old_version = self.pluginPrefs.get("version", "0.0.0")
-        if old_version != self.pluginVersion:
-            self.logger.debug(f"Upgrading plugin from version {old_version} to {self.pluginVersion}")
+        # Copying the Decoders/Templates trees on upgrade is left to install_support_files, run on first
+        # use or from runConcurrentThread once the devices have started.
+        self.supportFilesPending = self.pluginPrefs.get("version", "0.0.0") != self.pluginVersion
+        self.supportFilesLock = threading.Lock()
+
+        # startup timing: phase -> seconds, plus deviceStartComm [count, total, max]
+        self.startupTimings: dict[str, float] = {"init": time.perf_counter() - init_start}
+        self.startupStart = init_start
+        self.deviceStartTimes = [0, 0.0, 0.0]
+
+    def install_support_files(self) -> None:
+        if not self.supportFilesPending:
+            return
+        with self.supportFilesLock:
+            if not self.supportFilesPending:
+                return
+            self.supportFilesPending = False
+            self.logger.debug(f"Upgrading plugin from version {self.pluginPrefs.get('version', '0.0.0')} to {self.pluginVersion}")
+            start = time.perf_counter()
             try:
                 shutil.copytree("./Decoders/", f"{indigo.server.getInstallFolderPath()}/../Python3-includes/MQTT Shims Decoders/", dirs_exist_ok=True)
                 shutil.copytree("./Templates/", f"{indigo.server.getInstallFolderPath()}/../Python3-includes/MQTT Shims Templates/", dirs_exist_ok=True)
@@ -79,22 +1204,158 @@ class Plugin(indigo.PluginBase):
                 self.logger.error(f"Error copying Decoders/Templates during upgrade: {err}")
             else:
                 self.pluginPrefs["version"] = self.pluginVersion
+            self.startupTimings["support files"] = time.perf_counter() - start
+
+    # Logged once, from the first runConcurrentThread pass, after Indigo has started all the devices
+    def report_startup_timing(self) -> None:
+        count, total, longest = self.deviceStartTimes
+        phases = ", ".join(f"{phase} {seconds * 1000:.1f} ms" for phase, seconds in self.startupTimings.items())
+        self.logger.info(f"Startup took {(time.perf_counter() - self.startupStart) * 1000:.0f} ms: {phases}, "
+                         f"deviceStartComm {count} devices {total * 1000:.1f} ms (max {longest * 1000:.1f} ms)")
 
     def startup(self) -> Optional[str]:
+        start = time.perf_counter()
         self.logger.info("Starting MQTT Shims")
         if not self.mqttPlugin.isEnabled():
             return "MQTT Connector plugin not enabled!"
 
         indigo.server.subscribeToBroadcast("com.flyingdiver.indigoplugin.mqtt", "com.flyingdiver.indigoplugin.mqtt-message_queued", "message_handler")
+        if bool(self.pluginPrefs.get("directMQTT", False)) and not PAHO_AVAILABLE:
+            self.logger.error("Direct MQTT connection needs the paho-mqtt package, using the MQTT Connector")
+
+        # Give deviceStartComm a chance to run for all the shims before sweeping them
+        if bool(self.pluginPrefs.get("statusSweepAtStartup", False)):
+            self.statusSweepStartTime = time.monotonic() + float(self.pluginPrefs.get("statusSweepDelay", 10))
+        self.startupTimings["startup"] = time.perf_counter() - start
 
     def message_handler(self, notification: dict) -> None:
-        self.logger.debug(f"message_handler: MQTT message {notification['message_type']} from {indigo.devices[int(notification['brokerID'])].name}")
-        self.messageQueue.put(notification)
+        if self.debugLogging:
+            self.logger.debug(f"message_handler: MQTT message {notification['message_type']} from {indigo.devices[int(notification['brokerID'])].name}")
+        brokerID = int(notification['brokerID'])
+        if not (pipeline := self.pipelines.get(brokerID)):
+            return      # no started shims on this broker
+        if not pipeline.put(notification['message_type']):
+            self.logger.warning(f"Notification backlog full for broker {brokerID}, dropping notifications until it drains (counted in the queue stats)")
 
     def shutdown(self) -> None:
         self.logger.info("Stopping MQTT Shims")
+        with self.pipelinesLock:
+            for pipeline in self.pipelines.values():
+                pipeline.stop()
+            self.pipelines.clear()
+            for direct in self.directClients.values():
+                direct.stop()
+            self.directClients.clear()
+        with self.decoderPoolLock:
+            if self.decoderPool:
+                self.decoderPool.terminate()
+                self.decoderPool = None
+
+        # flush the log queue and put the handlers back for anything logged after this
+        self.logListener.stop()
+        self.logHandlersOwner.removeHandler(self.logQueueHandler)
+        for handler in (self.indigo_log_handler, self.plugin_file_handler):
+            handler.setLevel(self.logLevel)
+            self.logHandlersOwner.addHandler(handler)
+
+    def set_log_level(self, level: int) -> None:
+        self.logLevel = level
+        self.logFilter.level = level
+        self.debugLogging = level <= logging.DEBUG
+        self.threadDebugLogging = level < logging.DEBUG
+        self.logger.debug(f"logLevel = {self.logLevel}")
+
+    # The logger to use for a device's debug messages, and whether debug messages are wanted for it
+    def device_logging(self, device: indigo.Device) -> tuple[Any, bool]:
+        if device_logger := self.deviceLoggers.get(device.id):
+            return device_logger, True
+        return self.logger, self.debugLogging
+
+    def add_to_pipeline(self, device: indigo.Device) -> None:
+        brokerID = int(device.pluginProps['brokerID'])
+        pattern = None
+        if device.pluginProps.get('uid_location') == "pattern":
+            try:
+                pattern = self.topic_pattern(device)
+            except ValueError as err:
+                self.logger.error(f"{device.name}: invalid topic pattern: {err}")
+                return
+        with self.pipelinesLock:
+            if not (pipeline := self.pipelines.get(brokerID)):
+                self.logger.debug(f"Starting message pipeline for broker {brokerID}")
+                pipeline = BrokerPipeline(brokerID, self.runPipeline, self.MAX_PENDING_NOTIFICATIONS, self.STARVATION_LIMIT)
+                self.pipelines[brokerID] = pipeline
+                pipeline.start()
+            priority = device.pluginProps.get('priority', self.DEFAULT_PRIORITY.get(device.deviceTypeId, "normal"))
+            pipeline.add_device(device.id, device.pluginProps['message_type'], pattern, device.address, priority)
+            if bool(self.pluginPrefs.get("directMQTT", False)) and PAHO_AVAILABLE and brokerID not in self.directFailed:
+                self.add_direct_subscriptions(device, brokerID, pattern)
+
+    # Subscribe the device's topics on this plugin's own connection to the broker.  A device whose topics
+    # can't be worked out (no topic pattern and no connector trigger for its message type) stays on the
+    # connector.  Called with pipelinesLock held.
+    def add_direct_subscriptions(self, device: indigo.Device, brokerID: int, pattern: Optional[list]) -> None:
+        message_type = device.pluginProps['message_type']
+        if pattern:
+            filters = [pattern_filter(pattern)]
+        else:
+            filters = self.trigger_filters(brokerID, message_type)
+        if not filters:
+            self.logger.warning(f"{device.name}: no topics known for message type '{message_type}', using the MQTT Connector")
+            return
+        if not (direct := self.directClients.get(brokerID)):
+            broker = indigo.devices[brokerID]
+            # TLS if the connector's broker uses it or the plugin config asks for it
+            tls = bool(self.pluginPrefs.get("directMQTTTLS", False)) or bool(broker.pluginProps.get("useTLS", False))
+            host = self.pluginPrefs.get("directMQTTHost", "").strip() or broker.pluginProps.get("address", "localhost")
+            try:
+                port = int(self.pluginPrefs.get("directMQTTPort", "").strip() or broker.pluginProps.get("port", 8883 if tls else 1883))
+            except ValueError:
+                port = 8883 if tls else 1883
+            try:
+                direct = DirectMQTT(brokerID, broker.name, host, port, broker.pluginProps.get("username", ""), broker.pluginProps.get("password", ""),
+                                    tls, self.pluginPrefs.get("directMQTTCACerts", "").strip(), self.logger,
+                                    lambda queued_type, pipeline=self.pipelines[brokerID]: pipeline.put(queued_type))
+            except Exception as err:
+                self.logger.error(f"{broker.name}: unable to set up the direct connection to {host}:{port}, using the MQTT Connector: {err}")
+                self.directFailed.add(brokerID)
+                return
+            self.logger.info(f"{broker.name}: connecting directly to {direct.describe()}")
+            self.directClients[brokerID] = direct
+            direct.start()
+        self.logger.debug(f"{device.name}: direct subscriptions {filters} for '{message_type}'")
+        direct.add_device(device.id, message_type, filters)
+
+    @staticmethod
+    def trigger_filters(brokerID: int, message_type: str) -> list[str]:
+        filters = []
+        for trigger in indigo.triggers:
+            try:
+                if trigger.pluginId == 'com.flyingdiver.indigoplugin.mqtt' and trigger.pluginTypeId == 'topicMatch':
+                    props = trigger.globalProps['com.flyingdiver.indigoplugin.mqtt']
+                    if props['message_type'] == message_type and str(props.get('brokerID', brokerID)) == str(brokerID):
+                        if (topic_filter := match_list_filter(props['match_list'])) and topic_filter not in filters:
+                            filters.append(topic_filter)
+            except (Exception,):
+                pass
+        return filters
+
+    def remove_from_pipeline(self, device: indigo.Device) -> None:
+        with self.pipelinesLock:
+            for brokerID, pipeline in list(self.pipelines.items()):
+                pipeline.remove_device(device.id)
+                if direct := self.directClients.get(brokerID):
+                    direct.remove_device(device.id)
+                if not pipeline.device_ids:
+                    self.logger.debug(f"Stopping message pipeline for broker {brokerID}")
+                    pipeline.stop()
+                    del self.pipelines[brokerID]
+                    if direct := self.directClients.pop(brokerID, None):
+                        direct.stop()
+                    self.directFailed.discard(brokerID)      # retried when its shims start again
 
     def deviceStartComm(self, device: indigo.Device) -> None:
+        start = time.perf_counter()
         self.logger.info(f"{device.name}: Starting Device")
 
         instanceVers = int(device.pluginProps.get('devVersCount', 0))
@@ -110,16 +1371,36 @@ class Plugin(indigo.PluginBase):
         else:
             self.logger.error(f"{device.name}: Unknown device version: {instanceVers}")
 
+        # replacePluginPropsOnServer is a server round trip, so only write SupportsColor when it isn't set yet
         props = device.pluginProps
-        if device.deviceTypeId == 'shimColor':
+        if device.deviceTypeId == 'shimColor' and not props.get("SupportsColor", False):
             props["SupportsColor"] = True
             device.replacePluginPropsOnServer(props)
 
         if device.id in self.shimDevices:
             self.logger.error(f"{device.name}: deviceStartComm called for an already-started device, ignoring")
             return
+        if bool(device.pluginProps.get('debug_logging', False)):
+            self.deviceLoggers[device.id] = logging.LoggerAdapter(self.logger, {'trace': True})
         self.shimDevices.append(device.id)
+        if bool(device.pluginProps.get('decoder_process', False)):
+            self.decoderProcessDevices.add(device.id)
         self.messageTypesWanted.append(device.pluginProps['message_type'])
+        self.add_to_pipeline(device)
+
+        if self.rolling_stats_enabled(device) or self.optimistic_enabled(device) or self.watchdog_interval(device):
+            device.stateListOrDisplayStateIdChanged()
+
+        if interval := self.watchdog_interval(device):
+            self.watchdog.arm(device.id, interval, time.monotonic())
+            # online until a full interval passes without a message, whatever it was when the plugin stopped
+            if device.states.get('online') is not True:
+                device.updateStateOnServer('online', True)
+
+        elapsed = time.perf_counter() - start
+        self.deviceStartTimes[0] += 1
+        self.deviceStartTimes[1] += elapsed
+        self.deviceStartTimes[2] = max(self.deviceStartTimes[2], elapsed)
 
     def deviceStopComm(self, device: indigo.Device) -> None:
         self.logger.info(f"{device.name}: Stopping Device")
@@ -127,8 +1408,21 @@ class Plugin(indigo.PluginBase):
             self.logger.error(f"{device.name}: deviceStopComm called for a device that wasn't started, ignoring")
             return
         self.shimDevices.remove(device.id)
+        self.deviceLoggers.pop(device.id, None)
+        self.decoderProcessDevices.discard(device.id)
+        self.decoderBackoff.pop(device.id, None)
+        self.updateFunctions.pop(device.id, None)
         if device.pluginProps['message_type'] in self.messageTypesWanted:
             self.messageTypesWanted.remove(device.pluginProps['message_type'])
+        self.remove_from_pipeline(device)
+        for state_key in ('sensorValue', 'curEnergyLevel'):
+            self.accumulators.pop((device.id, state_key), None)
+        self.rollingStats.pop(device.id, None)
+        self.watchdog.disarm(device.id)
+        self.structLayouts.pop(device.id, None)
+        self.topicPatterns.pop(device.id, None)
+        with self.pendingCommandsLock:
+            self.pendingCommands.pop(device.id, None)
 
     def validateDeviceConfigUi(self, valuesDict: indigo.Dict, typeId: str, devId: int) -> tuple[bool, indigo.Dict]:
         self.logger.debug("validateDeviceConfigUi, devId={}, typeId={}, valuesDict = {}".format(devId, typeId, valuesDict))
@@ -152,13 +1446,58 @@ class Plugin(indigo.PluginBase):
         elif typeId == "shimGeneric":
             valuesDict["SupportsOnState"] = False
             valuesDict["SupportsSensorValue"] = False
+
+        if valuesDict.get("uid_location") == "pattern":
+            try:
+                levels = parse_topic_pattern(valuesDict.get("uid_location_topic_pattern", ""))
+                if not any(kind == '+' and name for kind, name in levels) and not any(kind == '#' and name for kind, name in levels):
+                    raise ValueError("the pattern needs a named capture such as '+uid'")
+            except ValueError as err:
+                errorsDict = indigo.Dict()
+                errorsDict["uid_location_topic_pattern"] = str(err)
+                return False, valuesDict, errorsDict
+
+        if valuesDict.get("state_location_payload_type") == "struct":
+            try:
+                self.compile_struct(valuesDict.get("struct_format", ""), valuesDict.get("struct_fields", ""))
+            except (struct.error, ValueError) as err:
+                errorsDict = indigo.Dict()
+                errorsDict["struct_format"] = str(err)
+                return False, valuesDict, errorsDict
+
+        if bool(valuesDict.get("decoder_process", False)):
+            try:
+                if float(valuesDict.get("decoder_timeout", 5)) <= 0:
+                    raise ValueError
+            except ValueError:
+                errorsDict = indigo.Dict()
+                errorsDict["decoder_timeout"] = "Timeout must be a positive number of seconds"
+                return False, valuesDict, errorsDict
         return True, valuesDict
 
     def didDeviceCommPropertyChange(self, oldDevice: indigo.Device, newDevice: indigo.Device) -> bool:
+        self.updateFunctions.pop(newDevice.id, None)      # respecialized for the new props on the next message
+        if self.updateCompiler:
+            self.updateCompiler.forget(newDevice.id)
+        self.decoderBackoff.pop(newDevice.id, None)       # a fixed decoder gets another chance
+        self.topicPatterns.pop(newDevice.id, None)
         if oldDevice.pluginProps.get('SupportsBatteryLevel') != newDevice.pluginProps.get('SupportsBatteryLevel'):
             return True
         if oldDevice.pluginProps.get('message_type') != newDevice.pluginProps.get('message_type'):
             return True
+        if oldDevice.pluginProps.get('brokerID') != newDevice.pluginProps.get('brokerID'):
+            return True
+        if oldDevice.pluginProps.get('uid_location') != newDevice.pluginProps.get('uid_location'):
+            return True
+        if oldDevice.pluginProps.get('uid_location_topic_pattern') != newDevice.pluginProps.get('uid_location_topic_pattern'):
+            return True
+        if oldDevice.address != newDevice.address:
+            return True
+        for key in ('rate_limit_interval', 'rate_limit_function', 'rate_limit_threshold',
+                    'SupportsRollingStats', 'rolling_stats_window', 'rolling_stats_samples', 'rolling_stats_states',
+                    'optimistic_updates', 'watchdog_interval', 'priority', 'debug_logging', 'decoder_process'):
+            if oldDevice.pluginProps.get(key) != newDevice.pluginProps.get(key):
+                return True
         if oldDevice.pluginProps.get('custom_decoder') != newDevice.pluginProps.get('custom_decoder'):
             if oldDevice.id in self.decoders:
                 del self.decoders[oldDevice.id]
@@ -166,7 +1505,7 @@ class Plugin(indigo.PluginBase):
 
     def triggerStartProcessing(self, trigger: indigo.Trigger) -> None:
         self.logger.debug(f"{trigger.name}: Adding Trigger")
-        if trigger.pluginTypeId not in ["deviceUpdated", "stateUpdated"]:
+        if trigger.pluginTypeId not in ["deviceUpdated", "stateUpdated", "deviceOffline"]:
             self.logger.error(f"{trigger.name}: unexpected trigger type '{trigger.pluginTypeId}', ignoring")
             return
         self.triggers[trigger.id] = trigger
@@ -177,40 +1516,214 @@ class Plugin(indigo.PluginBase):
             del self.triggers[trigger.id]
 
     def runConcurrentThread(self) -> None:
+        # Message handling runs on the per-broker pipeline threads; this thread does the timed work.
         try:
+            self.install_support_files()
+            self.report_startup_timing()
             while True:
-                self.processMessages()
+                self.flushAccumulators()
+                self.runStatusSweep()
+                self.expirePendingCommands()
+                self.runWatchdog()
+                if self.profileUntil and time.monotonic() >= self.profileUntil:
+                    self.finishProfiling()
                 self.sleep(0.1)
 
         except self.StopThread:
             pass
 
-    def processMessages(self) -> None:
+    def runPipeline(self, pipeline: BrokerPipeline) -> None:
+        while not pipeline.stopping:
+            pipeline.wakeup.wait(1.0)
+            pipeline.wakeup.clear()
+            if pipeline.stopping:
+                break
+            try:
+                # Only one profiler can be active in the interpreter at a time, so a pass that finds
+                # another pipeline already being profiled just runs unprofiled.
+                if self.profileUntil and self.profilerLock.acquire(blocking=False):
+                    try:
+                        profile = cProfile.Profile()
+                        profile.runcall(self.processMessages, pipeline)
+                    finally:
+                        self.profilerLock.release()
+                    with self.profilesLock:
+                        self.profiles.append(profile)
+                else:
+                    self.processMessages(pipeline)
+            except Exception as err:
+                self.logger.exception(f"Broker {pipeline.brokerID}: error processing messages: {err}")
+
+    def processMessages(self, pipeline: BrokerPipeline) -> None:
 
         # Re-fetch a fresh handle each pass: the cached one goes stale if the MQTT
         # Connector plugin is reloaded/upgraded while we're running.
-        self.mqttPlugin = indigo.server.getPlugin("com.flyingdiver.indigoplugin.mqtt")
-
-        while not self.messageQueue.empty():
-            notification = self.messageQueue.get()
-            if not notification:
-                continue
+        mqttPlugin = indigo.server.getPlugin("com.flyingdiver.indigoplugin.mqtt")
+        direct = self.directClients.get(pipeline.brokerID)
 
-            if notification["message_type"] not in self.messageTypesWanted:
+        while not pipeline.stopping and (next_message_type := pipeline.next()):
+            message_type, rank, queued = next_message_type
+            if message_type not in self.messageTypesWanted:
                 continue
 
-            props = {'message_type': notification["message_type"]}
-            brokerID = int(notification['brokerID'])
-            while True:
-                message_data = self.mqttPlugin.executeAction("fetchQueuedMessage", deviceId=brokerID, props=props, waitUntilDone=True)
+            props = {'message_type': message_type}
+            fetched = 0
+            decoding = deque()      # messages waiting on the decoder process pool, applied in arrival order
+            batch = ValueBatch() if NUMPY_AVAILABLE else None
+            while not pipeline.stopping:
+                if fetched >= self.MAX_FETCH_PER_PASS:
+                    # more may be waiting; come back to this message type after the others have had a turn
+                    pipeline.requeue(message_type)
+                    break
+                if pipeline.preempts(rank):
+                    # a higher priority message type is waiting, let it go first
+                    pipeline.requeue(message_type, queued)
+                    break
+                # the direct connection's messages first, then whatever the connector has queued for this type
+                from_direct = direct is not None and direct.serves(message_type) and (message_data := direct.fetch(message_type)) is not None
+                if not from_direct:
+                    message_data = mqttPlugin.executeAction("fetchQueuedMessage", deviceId=pipeline.brokerID, props=props, waitUntilDone=True)
                 if message_data is None:
                     break
-                for deviceID in list(self.shimDevices):    # snapshot: deviceStopComm may mutate concurrently
-                    device = indigo.devices[deviceID]
-                    if device.pluginProps['message_type'] == notification["message_type"]:
-                        self.logger.debug(
-                            f"{device.name}: processMessages: '{notification['message_type']}' {'/'.join(message_data['topic_parts'])} -> {message_data['payload']}")
-                        self.update(device, message_data["topic_parts"], message_data["payload"])
+                fetched += 1
+                start = time.perf_counter()
+                device_ids = pipeline.route(message_type, message_data["topic_parts"])
+                if direct and device_ids and (from_direct or direct.connected):
+                    # each device takes its messages from one source only, the connector covering while the connection is down
+                    if not (device_ids := [deviceID for deviceID in device_ids if direct.serves_device(deviceID) == from_direct]):
+                        direct.stats["discarded"] += 1      # the connector's copy of a message that also came in directly
+                        continue
+                devices = [indigo.devices[deviceID] for deviceID in device_ids]
+                jobs, matches = self.submit_decodes(devices, message_data) if self.decoderProcessDevices else ({}, {})
+                if jobs or decoding:
+                    # once one message is waiting on the pool, later ones queue behind it to keep their order
+                    decoding.append((start, devices, message_data, jobs, matches))
+                    if len(decoding) >= self.DECODER_WINDOW:
+                        self.apply_message(pipeline, message_type, batch, *decoding.popleft())
+                else:
+                    self.apply_message(pipeline, message_type, batch, start, devices, message_data, jobs, matches)
+            while decoding:
+                self.apply_message(pipeline, message_type, batch, *decoding.popleft())
+            if batch is not None:
+                self.flush_value_batch(batch)
+            pipeline.count_fetched(fetched, rank)
+
+    def apply_message(self, pipeline: BrokerPipeline, message_type: str, batch: Optional[ValueBatch], start: float,
+                      devices: list[indigo.Device], message_data: dict, jobs: dict[int, tuple], matches: dict[int, tuple]) -> None:
+        outcome, uid = TrafficStats.MISMATCH, None
+        flushed = batch.flush_seconds if batch is not None else 0.0
+        for device in devices:
+            log, debug = self.device_logging(device)
+            if debug:
+                log.debug(f"{device.name}: processMessages: '{message_type}' {'/'.join(message_data['topic_parts'])} -> {message_data['payload']}")
+            update = self.updateFunctions.get(device.id) or self.compile_update(device)
+            device_outcome, device_uid = update(self, device, message_data["topic_parts"], message_data["payload"], jobs.get(device.id), batch,
+                                               matches.get(device.id))
+            if TrafficStats.RANK[device_outcome] > TrafficStats.RANK[outcome]:
+                outcome, uid = device_outcome, device_uid if device_uid is not None else uid
+            elif uid is None:
+                uid = device_uid
+        if not devices:
+            uid = pipeline.pattern_uid(message_type, message_data["topic_parts"])
+        # an earlier message's batched work flushed in the middle of this one is charged to that message
+        elapsed = time.perf_counter() - start - (batch.flush_seconds - flushed if batch is not None else 0.0)
+        self.traffic.record(pipeline.brokerID, message_type, uid, outcome, len(payload_bytes(message_data["payload"] or "")),
+                            elapsed, '/'.join(message_data["topic_parts"]))
+        if batch is not None:
+            batch.tag((pipeline.brokerID, message_type, uid))
+
+    def compile_update(self, device: indigo.Device) -> Any:
+        update = Plugin.update
+        if self.updateCompiler:
+            try:
+                update = self.updateCompiler.compile(device)
+            except Exception as err:
+                self.logger.error(f"{device.name}: unable to specialize update function, using update(): {err}")
+            else:
+                self.logger.debug(f"{device.name}: specialized update function ready, {len(self.updateCompiler.cache)} props shapes compiled")
+        self.updateFunctions[device.id] = update
+        return update
+
+    # Start decode() in the decoder process pool for each routed device that runs its decoder there
+    # and that this message is actually for.  Returns device id -> job, and device id -> match_uid()
+    # result for the devices checked, which update() takes rather than matching (and logging) again.
+    # A device whose decoder is backing off after a timeout gets a job with no pool, which fails at once.
+    def submit_decodes(self, devices: list[indigo.Device], message_data: dict) -> tuple[dict[int, tuple], dict[int, tuple]]:
+        jobs = {}
+        matches = {}
+        for device in devices:
+            if device.id not in self.decoderProcessDevices:
+                continue
+            decoder_file = device.pluginProps.get('custom_decoder')
+            if not decoder_file or decoder_file == '0':
+                continue
+            match = matches[device.id] = self.match_uid(device, message_data["topic_parts"], message_data["payload"])
+            if match[0] != TrafficStats.MATCHED:
+                continue
+            payload = message_data["payload"]
+            if device.pluginProps.get('state_location_payload_type') == "struct":
+                args = (device.id, decoder_file, self.unpack_struct(device, payload), False)
+            else:
+                args = (device.id, decoder_file, payload_bytes(payload), True)
+            if self.decoder_backing_off(device.id):
+                jobs[device.id] = (None, None, args, time.monotonic())
+            elif job := self.submit_decode(args):
+                jobs[device.id] = job
+        return jobs, matches
+
+    def submit_decode(self, args: tuple) -> Optional[tuple]:
+        if not (pool := self.decoder_pool()):
+            return None     # no pool, update() falls back to decoding in-process
+        return pool, pool.apply_async(decoder_worker.decode, args), args, time.monotonic()
+
+    def decoder_pool(self) -> Any:
+        with self.decoderPoolLock:
+            if self.decoderPool is None and not self.decoderPoolFailed:
+                try:
+                    self.decoderPool = multiprocessing.get_context("spawn").Pool(self.DECODER_PROCESSES)
+                except Exception as err:
+                    self.logger.error(f"Unable to start decoder processes, running custom decoders in-process: {err}")
+                    self.decoderPoolFailed = True
+            return self.decoderPool
+
+    def decoder_backing_off(self, deviceID: int) -> bool:
+        return (backoff := self.decoderBackoff.get(deviceID)) is not None and time.monotonic() < backoff[1]
+
+    # Each job gets its timeout from when it was submitted, so the jobs behind a hung one don't each wait
+    # a full timeout again.  A timeout restarts the pool (the hung worker can't be stopped any other way)
+    # and skips the device's decoder for a while; its queued jobs fail without waiting, while other
+    # devices' jobs killed with the pool are run again.
+    def decoder_result(self, device: indigo.Device, job: tuple) -> tuple[bool, Any]:
+        if self.decoder_backing_off(device.id):
+            return False, None
+        pool, result, args, submitted = job
+        if pool is None or pool is not self.decoderPool:
+            # skipped while backing off, or submitted to a pool that has since been restarted: run it now
+            if not (job := self.submit_decode(args)):
+                return False, None
+            pool, result, args, submitted = job
+        try:
+            timeout = float(device.pluginProps.get('decoder_timeout', 5))
+        except ValueError:
+            timeout = 5.0
+        try:
+            output = result.get(max(0.0, submitted + timeout - time.monotonic()))
+        except multiprocessing.TimeoutError:
+            timeouts = self.decoderBackoff.get(device.id, (0, 0.0))[0] + 1
+            backoff = min(self.DECODER_BACKOFF * 2 ** (timeouts - 1), self.DECODER_BACKOFF_MAX)
+            self.decoderBackoff[device.id] = (timeouts, time.monotonic() + backoff)
+            self.logger.error(f"{device.name}: Custom decoder timed out after {timeout} seconds, restarting decoder processes "
+                              f"and skipping this decoder for {backoff:g} seconds")
+            with self.decoderPoolLock:
+                if pool is self.decoderPool:
+                    pool.terminate()
+                    self.decoderPool = None
+        except Exception as err:
+            self.logger.error(f"{device.name}: Decode error: {err}")
+        else:
+            self.decoderBackoff.pop(device.id, None)
+            return True, output
+        return False, None
 
     # Convert a brightness value from the external device-specific value to Indigo scale
 
@@ -251,24 +1764,21 @@ class Plugin(indigo.PluginBase):
     # Convert a color space dict from the external device-specific value to Indigo space
 
     def convert_color_space_import(self, device: indigo.Device, color_dict: dict) -> dict:
-        self.logger.debug(f"{device.name}: convert_color_space_import input: {color_dict}")
+        log, debug = self.device_logging(device)
+        if debug:
+            log.debug(f"{device.name}: convert_color_space_import input: {color_dict}")
         space = device.pluginProps.get("color_space", "Indigo")
         if space == "Indigo":
             return color_dict
         else:
-            if space == "HueA":
-                converter = Converter(GamutA)
-            elif space == "HueB":
-                converter = Converter(GamutB)
-            elif space == "HueC":
-                converter = Converter(GamutC)
-            else:
-                converter = Converter(GamutA)  # default?
+            converter = hue_converter(space)
 
             redLevel, greenLevel, blueLevel = converter.xy_to_rgb(color_dict['x'], color_dict['y'])
-            self.logger.debug(f"{device.name}: xy_to_rgb output: {redLevel} {greenLevel} {blueLevel}")
+            if debug:
+                log.debug(f"{device.name}: xy_to_rgb output: {redLevel} {greenLevel} {blueLevel}")
             output = {'redLevel': redLevel / 2.55, 'greenLevel': greenLevel / 2.55, 'blueLevel': blueLevel / 2.55}
-            self.logger.debug(f"{device.name}: convert_color_space_import output: {output}")
+            if debug:
+                log.debug(f"{device.name}: convert_color_space_import output: {output}")
             return output
 
     # Convert a color space dict from Indigo scale to the external device-specific value
@@ -279,14 +1789,7 @@ class Plugin(indigo.PluginBase):
         if space == "Indigo":
             return color_dict
         else:
-            if space == "HueA":
-                converter = Converter(GamutA)
-            elif space == "HueB":
-                converter = Converter(GamutB)
-            elif space == "HueC":
-                converter = Converter(GamutC)
-            else:
-                converter = Converter(GamutA)  # default?
+            converter = hue_converter(space)
 
             # A SetColorLevels action may carry only some channels; treat missing ones as 0.
             x, y = converter.rgb_to_xy(2.55 * color_dict.get('redLevel', 0),
@@ -297,68 +1800,54 @@ class Plugin(indigo.PluginBase):
             self.logger.debug(f"{device.name}: convert_color_space_export output: {output}")
             return output
 
-    def update(self, device: indigo.Device, topic_parts: list[str], payload: str) -> None:
+    def update(self, device: indigo.Device, topic_parts: list[str], payload: str, decode_job: Optional[tuple] = None,
+               batch: Optional[ValueBatch] = None, match: Optional[tuple[str, Optional[str]]] = None) -> tuple[str, Optional[str]]:
+        # Returns the message's TrafficStats outcome for this device and the uid it carried (None if unknown).
+        # decode_job is this message's decode() call already submitted to the decoder process pool, and match
+        # the match_uid() result submit_decodes got for it.  With a batch, a value sensor's adjustment,
+        # sensorValue write and triggers wait for flush_value_batch.
+        log, debug = self.device_logging(device)
+        decode_failed = False
         state_value = None
         state_key = None
         multi_states_dict = None
         decoder_output = None
         updated_state_keys = set()
+        reported_states = {}
 
         # first determine the UID (address) for this message
 
-        if device.pluginProps.get('uid_location', None) == "topic":
-            try:
-                topic_field = int(device.pluginProps['uid_location_topic_field'])
-            except (Exception,):
-                self.logger.error(f"{device.name}: error getting uid_location_topic_field, aborting")
-                return
-            try:
-                uid = topic_parts[topic_field]
-            except (Exception,):
-                self.logger.error(f"{device.name}: error getting uid value from topic, aborting")
-                return
-
-        elif device.pluginProps['uid_location'] == "payload":
-            try:
-                json_payload = json.loads(payload)
-            except (Exception,):
-                self.logger.error(f"{device.name}: JSON decode error for uid_location = payload, aborting")
-                return
-            try:
-                uid_location_payload_key = device.pluginProps['uid_location_payload_key']
-            except (Exception,):
-                self.logger.error(f"{device.name}: error getting uid_location_payload_key, aborting")
-                return
-            try:
-                uid = str(json_payload[uid_location_payload_key])
-            except (Exception,):
-                self.logger.error(f"{device.name}: error getting uid value from payload, aborting")
-                return
-
+        outcome, uid = match or self.match_uid(device, topic_parts, payload)
+        if outcome != TrafficStats.MATCHED:
+            return outcome, uid
         else:
-            self.logger.error(f"{device.name}: update can't determine uid location")
-            return
-
-        if device.pluginProps['address'].strip() != uid.strip():
-            self.logger.debug(f"{device.name}: update uid mismatch: {device.pluginProps['address']} != {uid}")
-            return
-        else:
-            self.logger.debug(f"{device.name}: update uid: {uid}")
-
-        # get the JSON payload, if there is one
-
-        try:
-            state_data = json.loads(payload)
-        except (Exception,):
-            state_data = None
+            if debug:
+                log.debug(f"{device.name}: update uid: {uid}")
+            if batch is not None and device.id in batch.device_ids:
+                self.flush_value_batch(batch)   # the device's earlier reading goes out before this message
+            if self.statusSweep:
+                self.statusSweep.answered(device.id)
+            back_online, last_seen_due = self.watchdog.seen(device.id, time.monotonic())
+            if back_online:
+                self.logger.info(f"{device.name}: back online")
+                device.updateStatesOnServer([{'key': 'online', 'value': True},
+                                             {'key': 'lastSeen', 'value': time.strftime('%Y-%m-%d %H:%M:%S')}])
+            elif last_seen_due:
+                device.updateStateOnServer('lastSeen', time.strftime('%Y-%m-%d %H:%M:%S'))
+
+        # get the JSON (or struct) payload, if there is one
+
+        state_data = self.parse_payload(device, payload)
 
         # do custom decoder processing, if any
 
-        if not self.decoders.get(device.id):    # if we don't have a decoder for this device, try to import one
+        if decode_job is None and not self.decoders.get(device.id):    # if we don't have a decoder for this device, try to import one
             decoder_file = device.pluginProps.get('custom_decoder')
             if decoder_file and decoder_file != '0':
+                self.install_support_files()
                 decoder_name = os.path.basename(decoder_file).split('.')[0]
-                self.logger.debug(f"{device.name}: Importing custom decoder {decoder_name} @ '{decoder_file}'")
+                if debug:
+                    log.debug(f"{device.name}: Importing custom decoder {decoder_name} @ '{decoder_file}'")
                 try:
                     decoder_spec = importlib.util.spec_from_file_location(decoder_name, decoder_file)
                     module = importlib.util.module_from_spec(decoder_spec)
@@ -368,17 +1857,29 @@ class Plugin(indigo.PluginBase):
                 except Exception as err:
                     self.logger.error(f"{device.name}: Custom decoder {decoder_name} @ '{decoder_file}' import error: {err}")
                 else:
-                    self.logger.debug(f"{device.name}: Custom decoder {decoder_name} @ '{decoder_file}' imported successfully")
+                    if debug:
+                        log.debug(f"{device.name}: Custom decoder {decoder_name} @ '{decoder_file}' imported successfully")
                     self.decoders[device.id] = decoder(decoder.__name__)
 
-        if decoder := self.decoders.get(device.id):
-            self.logger.debug(f"{device.name}: Using cached Custom decoder {decoder.name}")
+        if decode_job is not None:
+            success, decoder_output = self.decoder_result(device, decode_job)
+            decode_failed = not success
+            if debug:
+                log.debug(f"{device.name}: {decoder_output=} from decoder process")
+            if decoder_output:
+                device = self._register_dynamic_states(device, decoder_output, updated_state_keys, replace_states_list=False)
+
+        elif decoder := self.decoders.get(device.id):
+            if debug:
+                log.debug(f"{device.name}: Using cached Custom decoder {decoder.name}")
             try:
                 decoder_output = decoder.decode(state_data)
-                self.logger.debug(f"{device.name}: {decoder_output=}")
+                if debug:
+                    log.debug(f"{device.name}: {decoder_output=}")
             except Exception as err:
                 self.logger.error(f"{device.name}: Decode error: {err}")
                 decoder_output = None
+                decode_failed = True
 
             if decoder_output:
                 device = self._register_dynamic_states(device, decoder_output, updated_state_keys, replace_states_list=False)
@@ -403,37 +1904,37 @@ class Plugin(indigo.PluginBase):
         elif (device.pluginProps.get('state_location') == "payload") and (device.pluginProps.get('state_location_payload_type') == "raw"):
             state_value = payload
 
-        elif (device.pluginProps.get('state_location') == "payload") and (device.pluginProps.get('state_location_payload_type') == "json"):
+        elif (device.pluginProps.get('state_location') == "payload") and (device.pluginProps.get('state_location_payload_type') in ("json", "struct")):
 
             if not state_data:
                 self.logger.error(f"{device.name}: No JSON payload state_data for state_value")
-                return
+                return TrafficStats.FAILED, uid
 
             if not (state_key := device.pluginProps.get('state_location_payload_key')):
                 self.logger.error(f"{device.name}: error getting state_location_payload_key")
-                return
+                return TrafficStats.MATCHED, uid
 
             try:
                 state_value = self.find_key_value(state_key, state_data)
             except (Exception,):
                 self.logger.error(f"{device.name}: state_key {state_key} not found in state_data {state_data} aborting")
-                return
+                return TrafficStats.MATCHED, uid
 
         elif device.pluginProps.get('state_location') == "decoder":
 
             if not decoder_output:
                 self.logger.error(f"{device.name}: No decoder output available for state value, aborting")
-                return
+                return TrafficStats.MATCHED, uid
 
             if not (decoder_key := device.pluginProps.get('state_location_decoder_key')):
                 self.logger.error(f"{device.name}: error getting state_location_decoder_key")
-                return
+                return TrafficStats.MATCHED, uid
 
             try:
                 state_value = self.find_key_value(decoder_key, decoder_output)
             except (Exception,):
                 self.logger.error(f"{device.name}: decoder key {decoder_key} not found in decoder output, aborting")
-                return
+                return TrafficStats.MATCHED, uid
 
         else:
             state_value = None
@@ -452,15 +1953,18 @@ class Plugin(indigo.PluginBase):
 
         if bool(device.pluginProps.get('SupportsEnergyMeterCurPower')) and ("curEnergyLevel" in device.states):
             power = self.find_key_value(device.pluginProps['power_payload_key'], state_data)
-            device.updateStateOnServer('curEnergyLevel', power, uiValue=f'{power} W')
-            updated_state_keys.add('curEnergyLevel')
+            if (power := self.accumulate(device, 'curEnergyLevel', power)) is not None:
+                self.write_state_value(device, 'curEnergyLevel', power)
+                updated_state_keys.add('curEnergyLevel')
 
         # do multi-states processing, if any
         multi_states_key = device.pluginProps.get('state_dict_payload_key')
-        self.logger.debug(f"{device.name}: multi_states_key= {multi_states_key}")
+        if debug:
+            log.debug(f"{device.name}: multi_states_key= {multi_states_key}")
         if multi_states_key:
             multi_states_dict = self.find_key_value(multi_states_key, state_data)
-            self.logger.debug(f"{device.name}: multi_states_dict = {multi_states_dict}")
+            if debug:
+                log.debug(f"{device.name}: multi_states_dict = {multi_states_dict}")
             if type(multi_states_dict) is not dict:
                 self.logger.error(f"{device.name}: Device config error, bad Multi-States Key value: {multi_states_key}")
                 multi_states_dict = None
@@ -490,9 +1994,11 @@ class Plugin(indigo.PluginBase):
                 else:
                     isOn = (state_value == on_value)
 
-            self.logger.debug(f"{device.name}: Updating state to {isOn}")
+            if debug:
+                log.debug(f"{device.name}: Updating state to {isOn}")
             device.updateStateOnServer(key='onOffState', value=isOn)
             updated_state_keys.add('onOffState')
+            reported_states['onOffState'] = bool(isOn)
 
             if device.pluginProps["shimSensorSubtype"] == "Generic":
                 if isOn:
@@ -523,8 +2029,9 @@ class Plugin(indigo.PluginBase):
 
             value_key = device.pluginProps['value_location_payload_key']
             brightness = self.find_key_value(value_key, state_data)
-            self.logger.debug(
-                f"{device.name}: shimDimmer, state_key = {state_key}, value_key = {value_key}, state_data = {state_data}, state = {state_value}, brightness = {brightness}")
+            if debug:
+                log.debug(
+                    f"{device.name}: shimDimmer, state_key = {state_key}, value_key = {value_key}, state_data = {state_data}, state = {state_value}, brightness = {brightness}")
 
             if isinstance(state_value, bool):
                 isOn = state_value
@@ -535,7 +2042,8 @@ class Plugin(indigo.PluginBase):
                 device.updateStateImageOnServer(indigo.kStateImageSel.DimmerOn)
             else:
                 device.updateStateImageOnServer(indigo.kStateImageSel.DimmerOff)
-            self.logger.debug(f"{device.name}: Setting onOffState to {isOn}")
+            if debug:
+                log.debug(f"{device.name}: Setting onOffState to {isOn}")
             state_updates.append({'key': 'onOffState', 'value': isOn})
 
             if brightness is not None and isOn:
@@ -545,10 +2053,12 @@ class Plugin(indigo.PluginBase):
                     self.logger.error(f"{device.name}: unable to convert brightness '{brightness}' to a number")
                 else:
                     brightness = self.convert_brightness_import(device, brightness)
-                    self.logger.debug(f"{device.name}: Updating brightnessLevel to {brightness}")
+                    if debug:
+                        log.debug(f"{device.name}: Updating brightnessLevel to {brightness}")
                     state_updates.append({'key': 'brightnessLevel', 'value': brightness})
             device.updateStatesOnServer(state_updates)
             updated_state_keys.update(entry['key'] for entry in state_updates)
+            reported_states.update({entry['key']: entry['value'] for entry in state_updates})
 
         if device.deviceTypeId == "shimColor":
             state_updates = []
@@ -558,11 +2068,13 @@ class Plugin(indigo.PluginBase):
             if color_values:
                 color_values = self.convert_color_space_import(device, color_values)
 
-                self.logger.debug(f"{device.name}: Updating color values to {color_values}")
+                if debug:
+                    log.debug(f"{device.name}: Updating color values to {color_values}")
                 state_updates.append({'key': 'redLevel', 'value': color_values['redLevel']})
                 state_updates.append({'key': 'greenLevel', 'value': color_values['greenLevel']})
                 state_updates.append({'key': 'blueLevel', 'value': color_values['blueLevel']})
-                self.logger.debug(f"{device.name}: Updating states: {state_updates}")
+                if debug:
+                    log.debug(f"{device.name}: Updating states: {state_updates}")
 
             color_temp_key = device.pluginProps['color_temp_payload_key']
             color_temp = self.find_key_value(color_temp_key, state_data)
@@ -574,7 +2086,8 @@ class Plugin(indigo.PluginBase):
                     self.logger.error(f"{device.name}: unable to convert color temperature '{color_temp}' to a number")
                 else:
                     color_temp = self.convert_color_temp_import(device, color_temp)
-                    self.logger.debug(f"{device.name}: Updating color temperature to {color_temp}")
+                    if debug:
+                        log.debug(f"{device.name}: Updating color temperature to {color_temp}")
                     state_updates.append({'key': 'whiteTemperature', 'value': color_temp})
             device.updateStatesOnServer(state_updates)
             updated_state_keys.update(entry['key'] for entry in state_updates)
@@ -584,38 +2097,242 @@ class Plugin(indigo.PluginBase):
                 value = float(state_value)
             except (TypeError, ValueError):
                 self.logger.error(f"{device.name}: update() is unable to convert '{state_value}' to float")
-                return
+                return TrafficStats.FAILED, uid
 
             function = device.pluginProps.get("adjustmentFunction", None)
-            self.logger.threaddebug(f"{device.name}: update adjustmentFunction: '{function}'")
-            if function:
-                prohibited = ['indigo', 'requests', 'pyserial', 'oauthlib', 'os', 'logging', 'json', 'yaml', 'pystache', 'Queue']
-                if any(x in function for x in prohibited):
-                    self.logger.warning(f"{device.name}: Invalid method in adjustmentFunction: '{function}'")
-                else:
-                    # Evaluate in a restricted namespace: the incoming value as `x`, plus a
-                    # handful of safe numeric builtins.  No __import__/open/etc. are reachable,
-                    # and a bad formula logs an error instead of crashing the message thread.
-                    safe_builtins = {"abs": abs, "round": round, "min": min, "max": max,
-                                     "int": int, "float": float, "pow": pow}
-                    try:
-                        value = eval(function, {"__builtins__": safe_builtins}, {"x": value})
-                    except Exception as err:
-                        self.logger.error(f"{device.name}: error evaluating adjustmentFunction '{function}': {err}")
-            self.logger.debug(f"{device.name}: Updating state to {value}")
-
-            subtype_config = self.SENSOR_SUBTYPE_CONFIG.get(device.pluginProps["shimSensorSubtype"])
-            if subtype_config:
-                precision_default, image_sel, unit = subtype_config
-                precision = device.pluginProps.get("shimSensorPrecision", precision_default)
-                device.updateStateImageOnServer(image_sel)
-                device.updateStateOnServer(key='sensorValue', value=value, decimalPlaces=int(precision), uiValue=f'{value:.{precision}f}{unit}')
-                updated_state_keys.add('sensorValue')
-            else:
-                self.logger.debug(f"{device.name}: update, unknown shimSensorSubtype: {device.pluginProps['shimSensorSubtype']}")
+            if self.threadDebugLogging:
+                self.logger.threaddebug(f"{device.name}: update adjustmentFunction: '{function}'")
+            if batch is not None:
+                batch.add(device, value, function, updated_state_keys, reported_states)
+                return (TrafficStats.FAILED if decode_failed else TrafficStats.MATCHED), uid
+            self.write_sensor_value(device, self.adjust_value(device, function, value), updated_state_keys)
+
+        if reported_states:
+            self.reconcile_command(device, reported_states)
 
         # Now do any triggers
 
+        self.fire_triggers(device, updated_state_keys)
+        return (TrafficStats.FAILED if decode_failed else TrafficStats.MATCHED), uid
+
+    def adjust_value(self, device: indigo.Device, function: Optional[str], value: float) -> Any:
+        if function:
+            prohibited = ['indigo', 'requests', 'pyserial', 'oauthlib', 'os', 'logging', 'json', 'yaml', 'pystache', 'Queue']
+            if any(x in function for x in prohibited):
+                self.logger.warning(f"{device.name}: Invalid method in adjustmentFunction: '{function}'")
+            else:
+                # Evaluate in a restricted namespace: the incoming value as `x`, plus a
+                # handful of safe numeric builtins.  No __import__/open/etc. are reachable,
+                # and a bad formula logs an error instead of crashing the message thread.
+                safe_builtins = {"abs": abs, "round": round, "min": min, "max": max,
+                                 "int": int, "float": float, "pow": pow}
+                try:
+                    value = eval(function, {"__builtins__": safe_builtins}, {"x": value})
+                except Exception as err:
+                    self.logger.error(f"{device.name}: error evaluating adjustmentFunction '{function}': {err}")
+        return value
+
+    # The whole batch's readings for one formula in a single NumPy evaluation, or None if it can't be
+    # done exactly.  A reading whose result isn't finite gets None, for the scalar path to redo (and log).
+    @staticmethod
+    def adjust_values(function: str, values: list[float]) -> Optional[list[Optional[float]]]:
+        if not NUMPY_AVAILABLE or (code := compile_array_formula(function)) is None:
+            return None
+        import numpy
+        with numpy.errstate(all='ignore'):
+            try:
+                result = eval(code, {"__builtins__": {}}, {"x": numpy.array(values, dtype=numpy.float64)})
+            except Exception:
+                return None
+        if not isinstance(result, numpy.ndarray) or result.dtype != numpy.float64 or result.shape != (len(values),):
+            return None
+        return [value if finite else None for value, finite in zip(result.tolist(), numpy.isfinite(result).tolist())]
+
+    def write_sensor_value(self, device: indigo.Device, value: Any, updated_state_keys: set[str]) -> None:
+        self.add_rolling_sample(device, value)
+        if (value := self.accumulate(device, 'sensorValue', value)) is not None:
+            if self.write_state_value(device, 'sensorValue', value):
+                updated_state_keys.add('sensorValue')
+
+    def flush_value_batch(self, batch: ValueBatch) -> None:
+        entries, sources = batch.take()
+        if not entries:
+            return
+        start = time.perf_counter()
+        values = [entry[1] for entry in entries]
+        by_function: dict[str, list[int]] = {}
+        for index, entry in enumerate(entries):
+            if entry[2]:
+                by_function.setdefault(entry[2], []).append(index)
+        for function, indices in by_function.items():
+            adjusted = None
+            if len(indices) >= self.VALUE_BATCH_ARRAY_MIN:
+                adjusted = self.adjust_values(function, [values[index] for index in indices])
+            for position, index in enumerate(indices):
+                if adjusted and adjusted[position] is not None:
+                    values[index] = adjusted[position]
+                else:
+                    values[index] = self.adjust_value(entries[index][0], function, values[index])
+
+        # the rest of each update, in message order
+        for (device, _, _, updated_state_keys, reported_states), value in zip(entries, values):
+            self.write_sensor_value(device, value, updated_state_keys)
+            if reported_states:
+                self.reconcile_command(device, reported_states)
+            self.fire_triggers(device, updated_state_keys)
+
+        elapsed = time.perf_counter() - start
+        batch.flush_seconds += elapsed
+        if sources:
+            self.traffic.add_seconds(sources, elapsed)
+
+    def match_uid(self, device: indigo.Device, topic_parts: list[str], payload: Any) -> tuple[str, Optional[str]]:
+        # Find the message's uid for this device: TrafficStats.MATCHED if it's the device's address
+        log, debug = self.device_logging(device)
+        if device.pluginProps.get('uid_location', None) == "topic":
+            try:
+                topic_field = int(device.pluginProps['uid_location_topic_field'])
+            except (Exception,):
+                self.logger.error(f"{device.name}: error getting uid_location_topic_field, aborting")
+                return TrafficStats.CONFIG, None
+            try:
+                uid = topic_parts[topic_field]
+            except (Exception,):
+                self.logger.error(f"{device.name}: error getting uid value from topic, aborting")
+                return TrafficStats.FAILED, None
+
+        elif device.pluginProps['uid_location'] == "pattern":
+            try:
+                levels = self.topic_pattern(device)
+            except ValueError as err:
+                self.logger.error(f"{device.name}: invalid topic pattern: {err}, aborting")
+                return TrafficStats.CONFIG, None
+            if (captures := match_topic_pattern(levels, topic_parts)) is None:
+                if debug:
+                    log.debug(f"{device.name}: update topic {'/'.join(topic_parts)} doesn't match pattern")
+                return TrafficStats.MISMATCH, None
+            uid = topic_pattern_uid(captures)
+
+        elif device.pluginProps['uid_location'] == "payload":
+            if (json_payload := self.parse_payload(device, payload)) is None:
+                self.logger.error(f"{device.name}: payload decode error for uid_location = payload, aborting")
+                return TrafficStats.FAILED, None
+            try:
+                uid_location_payload_key = device.pluginProps['uid_location_payload_key']
+            except (Exception,):
+                self.logger.error(f"{device.name}: error getting uid_location_payload_key, aborting")
+                return TrafficStats.CONFIG, None
+            try:
+                uid = str(json_payload[uid_location_payload_key])
+            except (Exception,):
+                self.logger.error(f"{device.name}: error getting uid value from payload, aborting")
+                return TrafficStats.FAILED, None
+
+        else:
+            self.logger.error(f"{device.name}: update can't determine uid location")
+            return TrafficStats.CONFIG, None
+
+        if device.pluginProps['address'].strip() != uid.strip():
+            if debug:
+                log.debug(f"{device.name}: update uid mismatch: {device.pluginProps['address']} != {uid}")
+            return TrafficStats.MISMATCH, uid
+        return TrafficStats.MATCHED, uid
+
+    def write_state_value(self, device: indigo.Device, state_key: str, value: Any) -> bool:
+        # Write a (possibly aggregated) sensorValue or curEnergyLevel reading, with the formatting
+        # for that state.  Returns False if nothing was written.
+        log, debug = self.device_logging(device)
+        if state_key == 'curEnergyLevel':
+            device.updateStateOnServer('curEnergyLevel', value, uiValue=f'{value} W')
+            return True
+
+        if debug:
+            log.debug(f"{device.name}: Updating state to {value}")
+        subtype_config = self.SENSOR_SUBTYPE_CONFIG.get(device.pluginProps["shimSensorSubtype"])
+        if not subtype_config:
+            if debug:
+                log.debug(f"{device.name}: update, unknown shimSensorSubtype: {device.pluginProps['shimSensorSubtype']}")
+            return False
+        precision_default, image_sel, unit = subtype_config
+        precision = device.pluginProps.get("shimSensorPrecision", precision_default)
+        device.updateStateImageOnServer(image_sel)
+        state_updates = [{'key': 'sensorValue', 'value': value, 'decimalPlaces': int(precision), 'uiValue': f'{value:.{precision}f}{unit}'}]
+        if stats := self.rollingStats.get(device.id):
+            for option in device.pluginProps.get('rolling_stats_states', []):
+                if option in self.ROLLING_STATS:
+                    stat_key, _, accessor = self.ROLLING_STATS[option]
+                    stat = getattr(stats, accessor)()
+                    state_updates.append({'key': stat_key, 'value': stat, 'decimalPlaces': int(precision), 'uiValue': f'{stat:.{precision}f}'})
+        device.updateStatesOnServer(state_updates)
+        return True
+
+    @staticmethod
+    def rolling_stats_enabled(device: indigo.Device) -> bool:
+        return device.deviceTypeId == "shimValueSensor" and bool(device.pluginProps.get('SupportsRollingStats', False))
+
+    def add_rolling_sample(self, device: indigo.Device, value: float) -> None:
+        if not self.rolling_stats_enabled(device):
+            return
+        if not (stats := self.rollingStats.get(device.id)):
+            try:
+                window = 60.0 * float(device.pluginProps.get('rolling_stats_window', 5))
+                capacity = int(device.pluginProps.get('rolling_stats_samples', 300))
+            except ValueError:
+                self.logger.error(f"{device.name}: invalid rolling statistics window or sample count")
+                return
+            stats = RollingStats(max(capacity, 2), window)
+            self.rollingStats[device.id] = stats
+        stats.add(value, time.monotonic())
+
+    def accumulate(self, device: indigo.Device, state_key: str, value: Any) -> Any:
+        # Rate limiting: fold the reading into the device's window and return the value to write now,
+        # or None if the write is deferred to the end of the window.  Non-numeric readings and devices
+        # without a rate limit interval pass straight through.
+        try:
+            interval = float(device.pluginProps.get('rate_limit_interval') or 0)
+        except ValueError:
+            interval = 0
+        if interval <= 0:
+            return value
+        try:
+            reading = float(value)
+        except (TypeError, ValueError):
+            return value
+
+        key = (device.id, state_key)
+        with self.accumulatorLock:    # shared with flushAccumulators on the concurrent thread
+            if not (accumulator := self.accumulators.get(key)):
+                try:
+                    threshold = float(device.pluginProps['rate_limit_threshold'])
+                except (KeyError, ValueError):
+                    threshold = None
+                accumulator = WindowAccumulator(interval, device.pluginProps.get('rate_limit_function', 'last'), threshold)
+                self.accumulators[key] = accumulator
+
+            if accumulator.add(reading, time.monotonic()):
+                return accumulator.flush()
+        if self.threadDebugLogging:
+            self.logger.threaddebug(f"{device.name}: {state_key} reading {reading} held for aggregation")
+        return None
+
+    def flushAccumulators(self) -> None:
+        # Write out windows that have expired without a new reading arriving to close them.
+        now = time.monotonic()
+        for (deviceID, state_key), accumulator in list(self.accumulators.items()):
+            if not accumulator.expired(now):
+                continue
+            if deviceID not in self.shimDevices:
+                self.accumulators.pop((deviceID, state_key), None)
+                continue
+            with self.accumulatorLock:
+                value = accumulator.flush()
+            if value is None:
+                continue
+            device = indigo.devices[deviceID]
+            if self.write_state_value(device, state_key, value):
+                self.fire_triggers(device, {state_key})
+
+    def fire_triggers(self, device: indigo.Device, updated_state_keys: set[str]) -> None:
         for trigger in list(self.triggers.values()):    # snapshot: triggerStopProcessing may mutate concurrently
             if trigger.pluginProps["shimDevice"] == str(device.id):
                 if trigger.pluginTypeId == "deviceUpdated":
@@ -625,12 +2342,86 @@ class Plugin(indigo.PluginBase):
                     if state_name in updated_state_keys:
                         indigo.trigger.execute(trigger)
 
+    @staticmethod
+    def watchdog_interval(device: indigo.Device) -> float:
+        # expected reporting interval in seconds, 0 if the watchdog is off for this device
+        try:
+            return 60.0 * float(device.pluginProps.get('watchdog_interval') or 0)
+        except ValueError:
+            return 0.0
+
+    def runWatchdog(self) -> None:
+        now = time.monotonic()
+        for deviceID, deadline in self.watchdog.expired(now):
+            if deviceID not in indigo.devices:
+                self.watchdog.disarm(deviceID)
+                continue
+            device = indigo.devices[deviceID]
+            # lastSeen is when the last message arrived, i.e. one interval before the deadline
+            last_seen = time.time() - (now - deadline) - self.watchdog_interval(device)
+            self.logger.warning(f"{device.name}: no messages for {self.watchdog_interval(device) / 60:g} minutes, marking offline")
+            device.updateStatesOnServer([{'key': 'online', 'value': False},
+                                         {'key': 'lastSeen', 'value': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_seen))}])
+            for trigger in list(self.triggers.values()):
+                if trigger.pluginTypeId == "deviceOffline" and trigger.pluginProps["shimDevice"] == str(device.id):
+                    indigo.trigger.execute(trigger)
+
+    def parse_payload(self, device: indigo.Device, payload: Any) -> Any:
+        # Payload as a dict for the payload keys: JSON, or binary fields unpacked with the device's struct layout
+        if device.pluginProps.get('state_location_payload_type') == "struct":
+            return self.unpack_struct(device, payload)
+        try:
+            return json.loads(payload)
+        except (Exception,):
+            return None
+
+    @staticmethod
+    def compile_struct(struct_format: str, struct_fields: str) -> tuple[struct.Struct, list[str]]:
+        layout = struct.Struct(struct_format.strip())
+        names = [name.strip() for name in struct_fields.split(',') if name.strip()]
+        count = len(layout.unpack(bytes(layout.size)))
+        if count != len(names):
+            raise ValueError(f"struct format has {count} fields but {len(names)} field names were given")
+        return layout, names
+
+    def topic_pattern(self, device: indigo.Device) -> list[tuple[str, str]]:
+        # The device's parsed topic pattern, parsed once and cached like the struct layouts.  Raises ValueError.
+        pattern = device.pluginProps.get('uid_location_topic_pattern', '')
+        cached = self.topicPatterns.get(device.id)
+        if not cached or cached[0] != pattern:
+            cached = self.topicPatterns[device.id] = (pattern, parse_topic_pattern(pattern))
+        return cached[1]
+
+    def unpack_struct(self, device: indigo.Device, payload: Any) -> Optional[dict]:
+        struct_format = device.pluginProps.get('struct_format', '')
+        struct_fields = device.pluginProps.get('struct_fields', '')
+        cached = self.structLayouts.get(device.id)
+        if not cached or cached[0] != struct_format or cached[1] != struct_fields:
+            try:
+                layout, names = self.compile_struct(struct_format, struct_fields)
+            except (struct.error, ValueError) as err:
+                self.logger.error(f"{device.name}: invalid struct layout '{struct_format}': {err}")
+                return None
+            cached = (struct_format, struct_fields, layout, names)
+            self.structLayouts[device.id] = cached
+        _, _, layout, names = cached
+
+        payload = payload_bytes(payload)
+        try:
+            values = layout.unpack_from(payload)
+        except (struct.error, TypeError) as err:
+            self.logger.error(f"{device.name}: unable to unpack {len(payload)} byte payload with '{struct_format}': {err}")
+            return None
+        return {name: value.rstrip(b'\0').decode('utf-8', 'replace') if isinstance(value, bytes) else value
+                for name, value in zip(names, values)}
+
     def _register_dynamic_states(self, device: indigo.Device, raw_dict: dict, updated_state_keys: set[str],
                                   skip_none: bool = False, replace_states_list: bool = True) -> indigo.Device:
         # Turn a raw dict (from a multi-states payload or a custom decoder) into device states,
         # keeping the device's states_list in sync.  replace_states_list=True makes this run's
         # keys the device's whole states_list (stale keys are dropped); False unions them into
         # whatever's already there (keys from earlier runs are kept even if absent this time).
+        log, debug = self.device_logging(device)
         state_updates = []
         new_states = indigo.List()
         for key in raw_dict:
@@ -639,7 +2430,8 @@ class Plugin(indigo.PluginBase):
                 continue
             safe_key = safeKey(key)
             new_states.append(safe_key)
-            self.logger.debug(f"{device.name}: adding to state_updates: {safe_key}, {value}, {type(value)}")
+            if debug:
+                log.debug(f"{device.name}: adding to state_updates: {safe_key}, {value}, {type(value)}")
             if type(value) in (int, bool, str, float):
                 state_updates.append({'key': safe_key, 'value': value})
             else:
@@ -657,19 +2449,22 @@ class Plugin(indigo.PluginBase):
                     updated_states_list.append(key)
 
         if set(current_states) != set(updated_states_list):
-            self.logger.threaddebug(f"{device.name}: update, new states_list: {updated_states_list}")
+            if self.threadDebugLogging:
+                self.logger.threaddebug(f"{device.name}: update, new states_list: {updated_states_list}")
             newProps = device.pluginProps
             newProps["states_list"] = updated_states_list
             device.replacePluginPropsOnServer(newProps)
             device.stateListOrDisplayStateIdChanged()
 
-        self.logger.debug(f"{device.name}: updating device: {state_updates}")
+        if debug:
+            log.debug(f"{device.name}: updating device: {state_updates}")
         device.updateStatesOnServer(state_updates)
         updated_state_keys.update(new_states)
         return device
 
     def find_key_value(self, key_string: str, data_dict: Any) -> Any:
-        self.logger.threaddebug(f"find_key_value key_string = '{key_string}', data_dict= {data_dict}")
+        if self.threadDebugLogging:
+            self.logger.threaddebug(f"find_key_value key_string = '{key_string}', data_dict= {data_dict}")
         try:
             if key_string == '.':
                 value = data_dict
@@ -687,7 +2482,8 @@ class Plugin(indigo.PluginBase):
 
             else:
                 split = key_string.split('.', 1)
-                self.logger.threaddebug(f"find_key_value split[0] = {split[0]}, split[1] = {split[1]}")
+                if self.threadDebugLogging:
+                    self.logger.threaddebug(f"find_key_value split[0] = {split[0]}, split[1] = {split[1]}")
                 try:
                     if split[0][0] == '[':
                         new_data = data_dict[int(split[0][1:-1])]
@@ -700,7 +2496,8 @@ class Plugin(indigo.PluginBase):
         except Exception as e:
             self.logger.error(f"find_key_value error: {e}")
         else:
-            self.logger.threaddebug(f"find_key_value result = {value}")
+            if self.threadDebugLogging:
+                self.logger.threaddebug(f"find_key_value result = {value}")
             return value
 
     @staticmethod
@@ -717,6 +2514,16 @@ class Plugin(indigo.PluginBase):
         for key in add_states:
             dynamic_state = self.getDeviceStateDictForStringType(str(key), str(key), str(key))
             stateList.append(dynamic_state)
+        if self.rolling_stats_enabled(device):
+            for option in device.pluginProps.get('rolling_stats_states', []):
+                if option in self.ROLLING_STATS:
+                    stat_key, stat_label, _ = self.ROLLING_STATS[option]
+                    stateList.append(self.getDeviceStateDictForNumberType(stat_key, stat_label, stat_label))
+        if self.optimistic_enabled(device):
+            stateList.append(self.getDeviceStateDictForNumberType("commandLatency", "Command Latency (ms)", "Command Latency (ms)"))
+        if self.watchdog_interval(device):
+            stateList.append(self.getDeviceStateDictForBoolOnOffType("online", "Online", "Online"))
+            stateList.append(self.getDeviceStateDictForStringType("lastSeen", "Last Seen", "Last Seen"))
         self.logger.threaddebug(f"{device.name}: getDeviceStateList returning: {stateList}")
         return stateList
 
@@ -730,6 +2537,7 @@ class Plugin(indigo.PluginBase):
         return retList
 
     def get_decoder_list(self, filter: str = "", valuesDict: Optional[indigo.Dict] = None, typeId: str = "", targetId: int = 0) -> list:
+        self.install_support_files()
         decoder_dir = f"{indigo.server.getInstallFolderPath()}/../Python3-includes/MQTT Shims Decoders"
         decoders = {}
 
@@ -762,8 +2570,9 @@ class Plugin(indigo.PluginBase):
                 return
 
             payload = self.substitute(device.pluginProps.get("on_action_payload", "on"))
-            topic = pystache.render(action_template, {'uniqueID': device.address})
+            topic = render_template(action_template, {'uniqueID': device.address})
             self.publish_topic(device, topic, payload)
+            self.apply_optimistic(device, {'onOffState': True})
 
         elif action.deviceAction == indigo.kDeviceAction.TurnOff:
             action_template = device.pluginProps.get("action_template", None)
@@ -772,8 +2581,9 @@ class Plugin(indigo.PluginBase):
                 return
 
             payload = self.substitute(device.pluginProps.get("off_action_payload", "off"))
-            topic = pystache.render(action_template, {'uniqueID': device.address})
+            topic = render_template(action_template, {'uniqueID': device.address})
             self.publish_topic(device, topic, payload)
+            self.apply_optimistic(device, {'onOffState': False})
 
         elif action.deviceAction == indigo.kDeviceAction.Toggle:
             action_template = device.pluginProps.get("action_template", None)
@@ -782,8 +2592,9 @@ class Plugin(indigo.PluginBase):
                 return
 
             payload = self.substitute(device.pluginProps.get("toggle_action_payload", "toggle"))
-            topic = pystache.render(action_template, {'uniqueID': device.address})
+            topic = render_template(action_template, {'uniqueID': device.address})
             self.publish_topic(device, topic, payload)
+            self.apply_optimistic(device, {'onOffState': not device.onState})
 
         elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
             action_template = device.pluginProps.get("dimmer_action_template", None)
@@ -796,9 +2607,10 @@ class Plugin(indigo.PluginBase):
                 return
 
             payload_data = {'brightness': self.convert_brightness_export(device, action.actionValue)}
-            topic = pystache.render(action_template, {'uniqueID': device.address})
-            payload = pystache.render(payload_template, payload_data)
+            topic = render_template(action_template, {'uniqueID': device.address})
+            payload = render_template(payload_template, payload_data)
             self.publish_topic(device, topic, payload)
+            self.apply_optimistic(device, {'brightnessLevel': action.actionValue})
 
         elif action.deviceAction == indigo.kDeviceAction.BrightenBy:
 
@@ -816,9 +2628,10 @@ class Plugin(indigo.PluginBase):
                 return
 
             payload_data = {'brightness': self.convert_brightness_export(device, newBrightness)}
-            topic = pystache.render(action_template, {'uniqueID': device.address})
-            payload = pystache.render(payload_template, payload_data)
+            topic = render_template(action_template, {'uniqueID': device.address})
+            payload = render_template(payload_template, payload_data)
             self.publish_topic(device, topic, payload)
+            self.apply_optimistic(device, {'brightnessLevel': newBrightness})
 
         elif action.deviceAction == indigo.kDeviceAction.DimBy:
             newBrightness = device.brightness - action.actionValue
@@ -835,9 +2648,10 @@ class Plugin(indigo.PluginBase):
                 return
 
             payload_data = {'brightness': self.convert_brightness_export(device, newBrightness)}
-            topic = pystache.render(action_template, {'uniqueID': device.address})
-            payload = pystache.render(payload_template, payload_data)
+            topic = render_template(action_template, {'uniqueID': device.address})
+            payload = render_template(payload_template, payload_data)
             self.publish_topic(device, topic, payload)
+            self.apply_optimistic(device, {'brightnessLevel': newBrightness})
 
         elif action.deviceAction == indigo.kDeviceAction.SetColorLevels:
 
@@ -875,13 +2689,99 @@ class Plugin(indigo.PluginBase):
                 return
 
             # Render and send
-            topic = pystache.render(action_template, {'uniqueID': device.address})
-            payload = pystache.render(payload_template, payload_data)
+            topic = render_template(action_template, {'uniqueID': device.address})
+            payload = render_template(payload_template, payload_data)
             self.publish_topic(device, topic, payload)
 
         else:
             self.logger.error(f"{device.name}: actionControlDevice: Unsupported action requested: {action.deviceAction}")
 
+    ########################################
+    # Optimistic updates
+    ########################################
+
+    @staticmethod
+    def optimistic_enabled(device: indigo.Device) -> bool:
+        return device.deviceTypeId in ["shimRelay", "shimDimmer", "shimColor"] and bool(device.pluginProps.get('optimistic_updates', False))
+
+    def apply_optimistic(self, device: indigo.Device, expected: dict) -> None:
+        # Show the commanded state right away and remember it until the device echoes it back, so the
+        # echo can be timed and a command the device never acts on can be reverted.
+        if not self.optimistic_enabled(device):
+            return
+        if 'brightnessLevel' in expected:
+            expected['onOffState'] = expected['brightnessLevel'] > 0
+        with self.pendingCommandsLock:
+            # a command issued while another is pending reverts to the state from before the first one
+            if device.id in self.pendingCommands:
+                previous = self.pendingCommands[device.id][2]
+            else:
+                previous = {}
+            for key in expected:
+                previous.setdefault(key, device.states.get(key))
+            self.pendingCommands[device.id] = (time.monotonic(), expected, previous)
+        self.logger.debug(f"{device.name}: optimistic update to {expected}")
+        device.updateStatesOnServer([{'key': key, 'value': value} for key, value in expected.items()])
+
+    def reconcile_command(self, device: indigo.Device, reported_states: dict) -> None:
+        # Only a report matching the commanded state is its echo.  Anything else (a periodic report sent
+        # before the device acted on the command, say) leaves the command pending until its echo or its
+        # timeout; the report has already been written, so it becomes the state a timeout reverts to.
+        with self.pendingCommandsLock:
+            if not (pending := self.pendingCommands.get(device.id)):
+                return
+            sent, expected, previous = pending
+            matched = any(key in reported_states for key in expected) and \
+                all(key not in reported_states or
+                    (abs(reported_states[key] - value) <= 1 if key == 'brightnessLevel' else reported_states[key] == value)
+                    for key, value in expected.items())
+            if matched:
+                del self.pendingCommands[device.id]
+            else:
+                previous.update((key, reported_states[key]) for key in expected if key in reported_states)
+        if not matched:
+            log, debug = self.device_logging(device)
+            if debug:
+                log.debug(f"{device.name}: report {reported_states} doesn't match pending command {expected}, still waiting")
+            return
+
+        latency = time.monotonic() - sent
+        stats = self.commandLatency.setdefault(device.id, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+        device.updateStateOnServer('commandLatency', round(latency * 1000), uiValue=f'{latency * 1000:.0f} ms')
+
+    def expirePendingCommands(self) -> None:
+        now = time.monotonic()
+        expired = []
+        with self.pendingCommandsLock:
+            for deviceID, (sent, expected, previous) in list(self.pendingCommands.items()):
+                device = indigo.devices[deviceID]
+                try:
+                    timeout = float(device.pluginProps.get('optimistic_timeout', 5))
+                except ValueError:
+                    timeout = 5.0
+                if now - sent >= timeout:
+                    del self.pendingCommands[deviceID]
+                    expired.append((device, previous))
+        for device, previous in expired:
+            self.logger.warning(f"{device.name}: no response to command, reverting to {previous}")
+            device.updateStatesOnServer([{'key': key, 'value': value} for key, value in previous.items() if value is not None])
+
+    def logCommandLatency(self, valuesDict: Optional[indigo.Dict] = None, typeId: str = "") -> None:
+        if not self.commandLatency:
+            self.logger.info("No command latency measurements yet")
+            return
+        count = sum(stats[0] for stats in self.commandLatency.values())
+        total = sum(stats[1] for stats in self.commandLatency.values())
+        self.logger.info(f"Command latency: {count} commands, mean {1000 * total / count:.0f} ms, "
+                         f"max {1000 * max(stats[2] for stats in self.commandLatency.values()):.0f} ms")
+        by_mean = sorted(self.commandLatency.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)
+        for deviceID, (device_count, device_total, device_max) in by_mean:
+            name = indigo.devices[deviceID].name if deviceID in indigo.devices else deviceID
+            self.logger.info(f"    {name}: {device_count} commands, mean {1000 * device_total / device_count:.0f} ms, max {1000 * device_max:.0f} ms")
+
     ########################################
     # General Action callback
     ########################################
@@ -892,14 +2792,7 @@ class Plugin(indigo.PluginBase):
             self.logger.debug(f"{device.name}: actionControlUniversal: RequestStatus")
             if not bool(device.pluginProps.get('SupportsStatusRequest', False)):
                 self.logger.warning(f"{device.name}: actionControlUniversal: device does not support status requests")
-            else:
-                action_template = device.pluginProps.get("status_action_template", None)
-                if not action_template:
-                    self.logger.error(f"{device.name}: actionControlUniversal: no action template")
-                    return
-                payload = self.substitute(device.pluginProps.get("status_action_payload", ""))
-                topic = pystache.render(action_template, {'uniqueID': device.address})
-                self.publish_topic(device, topic, payload)
+            elif self.send_status_request(device):
                 self.logger.info(f"Sent '{device.name}' Status Request")
 
         #       elif action.deviceAction == indigo.kUniversalAction.EnergyReset:
@@ -909,14 +2802,76 @@ class Plugin(indigo.PluginBase):
         else:
             self.logger.error(f"{device.name}: actionControlUniversal: Unsupported action requested: {action.deviceAction}")
 
+    def send_status_request(self, device: indigo.Device) -> bool:
+        action_template = device.pluginProps.get("status_action_template", None)
+        if not action_template:
+            self.logger.error(f"{device.name}: send_status_request: no action template")
+            return False
+        payload = self.substitute(device.pluginProps.get("status_action_payload", ""))
+        topic = render_template(action_template, {'uniqueID': device.address})
+        self.publish_topic(device, topic, payload)
+        return True
+
+    ########################################
+    # Status sweep
+    ########################################
+
+    def startStatusSweep(self, valuesDict: Optional[indigo.Dict] = None, typeId: str = "") -> None:
+        if self.statusSweep:
+            self.logger.warning("Status sweep already in progress")
+            return
+        device_ids_by_broker = {}
+        for deviceID in list(self.shimDevices):
+            device = indigo.devices[deviceID]
+            if bool(device.pluginProps.get('SupportsStatusRequest', False)) and device.pluginProps.get('status_action_template'):
+                device_ids_by_broker.setdefault(int(device.pluginProps['brokerID']), []).append(deviceID)
+        if not device_ids_by_broker:
+            self.logger.info("Status sweep: no started devices support status requests")
+            return
+        try:
+            concurrency = int(self.pluginPrefs.get("statusSweepConcurrency", 5))
+            rate = float(self.pluginPrefs.get("statusSweepRate", 5))
+            timeout = float(self.pluginPrefs.get("statusSweepTimeout", 10))
+        except ValueError:
+            self.logger.error("Status sweep: invalid concurrency, rate or timeout in plugin config")
+            return
+        self.statusSweep = StatusSweep(device_ids_by_broker, concurrency, rate, timeout)
+        self.logger.info(f"Status sweep: requesting status from {self.statusSweep.total} devices on {len(device_ids_by_broker)} broker(s)")
+
+    def runStatusSweep(self) -> None:
+        if self.statusSweepStartTime and time.monotonic() >= self.statusSweepStartTime:
+            self.statusSweepStartTime = None
+            self.startStatusSweep()
+
+        if not (sweep := self.statusSweep):
+            return
+
+        def send(deviceID: int) -> bool:
+            if deviceID not in self.shimDevices:
+                return False
+            return self.send_status_request(indigo.devices[deviceID])
+
+        sweep.step(time.monotonic(), send)
+        if sweep.done():
+            self.statusSweep = None
+            elapsed = time.monotonic() - sweep.started
+            self.logger.info(f"Status sweep complete: {sweep.total} devices in {elapsed:.1f} seconds, {len(sweep.unanswered)} did not answer")
+            if sweep.unanswered:
+                names = [indigo.devices[deviceID].name if deviceID in indigo.devices else str(deviceID) for deviceID in sweep.unanswered]
+                self.logger.warning(f"Status sweep: no answer from {', '.join(sorted(names))}")
+
     def publish_topic(self, device: indigo.Device, topic: str, payload: str) -> None:
 
+        brokerID = int(device.pluginProps['brokerID'])
+        if (direct := self.directClients.get(brokerID)) and direct.publish(topic, payload):
+            self.logger.debug(f"{device.name}: publish_topic (direct): {topic} -> {payload}")
+            return
+
         mqttPlugin = indigo.server.getPlugin("com.flyingdiver.indigoplugin.mqtt")
         if not mqttPlugin.isEnabled():
             self.logger.error("MQTT Connector plugin not enabled, publish_topic aborting.")
             return
 
-        brokerID = int(device.pluginProps['brokerID'])
         props = {
             'topic': topic,
             'payload': payload,
@@ -932,10 +2887,7 @@ class Plugin(indigo.PluginBase):
 
     def closedPrefsConfigUi(self, valuesDict: indigo.Dict, userCancelled: bool) -> None:
         if not userCancelled:
-            self.logLevel = int(valuesDict.get("logLevel", logging.INFO))
-            self.indigo_log_handler.setLevel(self.logLevel)
-            self.plugin_file_handler.setLevel(self.logLevel)
-            self.logger.debug(f"logLevel = {self.logLevel}")
+            self.set_log_level(int(valuesDict.get("logLevel", logging.INFO)))
 
     ########################################
     # Custom Plugin Action callbacks (defined in Actions.xml)
@@ -949,6 +2901,106 @@ class Plugin(indigo.PluginBase):
         retList.sort(key=lambda tup: tup[1])
         return retList
 
+    def logQueueStats(self, valuesDict: Optional[indigo.Dict] = None, typeId: str = "") -> None:
+        with self.pipelinesLock:
+            pipelines = list(self.pipelines.values())
+        if not pipelines:
+            self.logger.info("No broker pipelines running")
+        for pipeline in pipelines:
+            with pipeline.lock:
+                stats = dict(pipeline.stats)
+                pending = len(pipeline.pending)
+                class_fetched = list(pipeline.class_fetched)
+            depths = pipeline.class_depths()
+            name = indigo.devices[pipeline.brokerID].name if pipeline.brokerID in indigo.devices else pipeline.brokerID
+            self.logger.info(f"{name}: {len(pipeline.device_ids)} devices, {pending} pending, {stats['received']} received, {stats['coalesced']} coalesced, "
+                             f"{stats['dropped']} dropped, {stats['requeued']} requeued, {stats['fetched']} messages fetched")
+            for priority, depth, fetched in zip(BrokerPipeline.PRIORITY_CLASSES, depths, class_fetched):
+                self.logger.info(f"    {priority} priority: {depth} pending, {fetched} messages fetched")
+            self.logger.info(f"    {stats['preempted']} preempted by higher priority, {stats['starved']} served early after waiting")
+            if direct := self.directClients.get(pipeline.brokerID):
+                self.logger.info(f"    direct connection to {direct.host}:{direct.port} {'up' if direct.connected else 'down'}: {len(direct.subscriptions)} subscriptions, "
+                                 f"{direct.stats['received']} received, {direct.stats['unmatched']} unmatched, {direct.stats['dropped']} dropped, "
+                                 f"{direct.stats['published']} published, {direct.stats['discarded']} connector copies discarded")
+
+    def logTrafficStats(self, valuesDict: indigo.Dict, typeId: str) -> bool:
+        try:
+            limit = int(valuesDict.get("limit", 20))
+        except ValueError:
+            self.logger.error(f"Invalid number of sources: {valuesDict.get('limit')}")
+            return False
+
+        def broker_name(brokerID: int) -> str:
+            return indigo.devices[brokerID].name if brokerID in indigo.devices else str(brokerID)
+
+        if not (wasteful := self.traffic.wasteful(limit)):
+            self.logger.info("No wasted MQTT traffic recorded")
+        else:
+            self.logger.info(f"Top {len(wasteful)} sources of messages no shim used:")
+            for (brokerID, message_type, uid), counts in wasteful:
+                self.logger.info(f"    {broker_name(brokerID)} '{message_type}' uid '{uid}': {counts[TrafficStats.RECEIVED]} received, "
+                                 f"{counts[TrafficStats.MATCHED_COUNT]} matched, {counts[TrafficStats.MISMATCHED]} uid mismatch, "
+                                 f"{counts[TrafficStats.FAILURES]} decode failures, {counts[TrafficStats.CONFIG_ERRORS]} shim config errors, "
+                                 f"{counts[TrafficStats.BYTES]} bytes, "
+                                 f"{counts[TrafficStats.SECONDS] * 1000:.1f} ms (e.g. '{self.traffic.samples.get((brokerID, message_type, uid), '')}')")
+
+        # Suggest a tighter connector trigger where most of a message type's messages are for uids no shim has
+        for (brokerID, message_type), totals in sorted(self.traffic.totals_by_message_type().items()):
+            received = totals[TrafficStats.RECEIVED]
+            unwanted = totals[TrafficStats.MISMATCHED]
+            if not received or unwanted / received < self.WASTED_TRAFFIC_WARNING:
+                continue
+            wanted = sorted({indigo.devices[deviceID].address for deviceID in self.shimDevices
+                             if deviceID in indigo.devices
+                             and int(indigo.devices[deviceID].pluginProps.get('brokerID', 0)) == brokerID
+                             and indigo.devices[deviceID].pluginProps.get('message_type') == message_type})
+            self.logger.info(f"{broker_name(brokerID)} '{message_type}': {unwanted} of {received} messages ({100 * unwanted / received:.0f}%) were for no shim. "
+                             f"Consider tightening the MQTT Connector trigger's match_list for '{message_type}' to the topics of: {', '.join(wanted) or 'no shims'}")
+
+        if bool(valuesDict.get("reset", False)):
+            self.traffic.reset()
+            self.logger.info("Traffic statistics reset")
+        return True
+
+    def startProfiling(self, valuesDict: indigo.Dict, typeId: str) -> bool:
+        if self.profileUntil:
+            self.logger.warning("Profiling already in progress")
+            return True
+        try:
+            duration = float(valuesDict.get("duration", 30))
+        except ValueError:
+            self.logger.error(f"Invalid profiling duration: {valuesDict.get('duration')}")
+            return False
+        with self.profilesLock:
+            self.profiles = []
+        self.profileUntil = time.monotonic() + duration
+        self.logger.info(f"Profiling message handling for {duration:.0f} seconds")
+        return True
+
+    def finishProfiling(self) -> None:
+        # Merge the per-pass profiles from all the pipeline threads, save them, and log a summary.
+        self.profileUntil = None
+        with self.profilesLock:
+            profiles, self.profiles = self.profiles, []
+        if not profiles:
+            self.logger.info("Profiling finished, no messages were processed")
+            return
+
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        path = os.path.join(indigo.server.getLogsFolderPath(pluginId=self.pluginId), f"profile-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+        try:
+            stats.dump_stats(path)
+        except OSError as err:
+            self.logger.error(f"Error saving profile to '{path}': {err}")
+            path = None
+
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(20)
+        self.logger.info(f"Profiling finished, {len(profiles)} processing passes{f', saved to {path}' if path else ''}\n{summary.getvalue()}")
+
     def dumpYAML(self, valuesDict: indigo.Dict, typeId: str) -> bool:
         device = indigo.devices[int(valuesDict["deviceID"])]
         template = {'type': device.deviceTypeId}
@@ -985,11 +3037,13 @@ class Plugin(indigo.PluginBase):
             except (Exception,):
                 pass
 
+        import yaml
         self.logger.info(f"\n{yaml.safe_dump(template, width=120, indent=4, default_flow_style=False)}")
         return True
 
     def pickDeviceTemplate(self, filter: Optional[str] = None, valuesDict: Optional[indigo.Dict] = None, typeId: int = 0, targetId: int = 0) -> list:
 
+        self.install_support_files()
         template_dir = f"{indigo.server.getInstallFolderPath()}/../Python3-includes/MQTT Shims Templates"
         templates = {}
 
@@ -1012,6 +3066,7 @@ class Plugin(indigo.PluginBase):
 
     def createDeviceFromTemplate(self, valuesDict: indigo.Dict, typeId: str) -> bool:
         self.logger.debug(f"createDeviceFromTemplate, typeId = {typeId}, valuesDict = {valuesDict}")
+        import yaml
         with open(valuesDict['deviceTemplatePath'], 'r') as stream:
             template = yaml.safe_load(stream)
 
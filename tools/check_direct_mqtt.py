@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# End-to-end check of the direct MQTT connection (the directMQTT plugin pref).  A minimal MQTT 3.1.1
+# broker (QoS 0, no auth) stands in for mosquitto and a fake MQTT Connector queues the same messages,
+# so this covers subscribing from deviceStartComm, taking direct messages ahead of the connector's
+# copies, connector-only shims, unsubscribing from deviceStopComm, the connect failure / connected /
+# lost log messages, and a TLS setup error falling back to the connector.  Needs paho-mqtt:
+#
+#     python3 tools/check_direct_mqtt.py
+
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+
+import paho.mqtt.client as paho_mqtt
+
+from indigo_stub import Device, load_plugin
+
+
+# Just enough of an MQTT 3.1.1 broker for one plugin client and one publisher
+class MiniBroker:
+    def __init__(self) -> None:
+        self.clients: list[tuple[socket.socket, list[str]]] = []      # (connection, topic filters)
+        self.lock = threading.Lock()
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+
+    def start(self) -> None:
+        self.server.listen()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            connection, _ = self.server.accept()
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def filters(self) -> list[str]:
+        with self.lock:
+            return [topic_filter for _, filters in self.clients for topic_filter in filters]
+
+    # Closes every client connection, as a broker restart would
+    def drop_clients(self) -> None:
+        with self.lock:
+            for connection, _ in self.clients:
+                connection.shutdown(socket.SHUT_RDWR)
+
+    @staticmethod
+    def read_packet(connection: socket.socket) -> tuple[int, bytes]:
+        head = connection.recv(1)
+        if not head:
+            return 0, b''
+        multiplier, length = 1, 0
+        while True:
+            byte = connection.recv(1)[0]
+            length += (byte & 127) * multiplier
+            multiplier *= 128
+            if not byte & 128:
+                break
+        data = b''
+        while len(data) < length:
+            data += connection.recv(length - len(data))
+        return head[0], data
+
+    @staticmethod
+    def packet(kind: int, body: bytes) -> bytes:
+        length, encoded = len(body), b''
+        while True:
+            byte, length = length % 128, length // 128
+            encoded += bytes([byte | (128 if length else 0)])
+            if not length:
+                return bytes([kind]) + encoded + body
+
+    @staticmethod
+    def topics(data: bytes, qos_bytes: bool) -> list[str]:
+        topics, index = [], 2
+        while index < len(data):
+            size = struct.unpack('>H', data[index:index + 2])[0]
+            topics.append(data[index + 2:index + 2 + size].decode())
+            index += 2 + size + (1 if qos_bytes else 0)
+        return topics
+
+    def serve(self, connection: socket.socket) -> None:
+        filters: list[str] = []
+        with self.lock:
+            self.clients.append((connection, filters))
+        try:
+            while True:
+                kind, data = self.read_packet(connection)
+                kind >>= 4
+                if kind in (0, 14):      # closed, DISCONNECT
+                    break
+                elif kind == 1:          # CONNECT
+                    connection.sendall(self.packet(0x20, b'\x00\x00'))
+                elif kind == 8:          # SUBSCRIBE
+                    topics = self.topics(data, True)
+                    with self.lock:
+                        filters.extend(topics)
+                    connection.sendall(self.packet(0x90, data[:2] + b'\x00' * len(topics)))
+                elif kind == 10:         # UNSUBSCRIBE
+                    with self.lock:
+                        filters[:] = [topic_filter for topic_filter in filters if topic_filter not in self.topics(data, False)]
+                    connection.sendall(self.packet(0xb0, data[:2]))
+                elif kind == 3:          # PUBLISH, QoS 0
+                    topic = data[2:2 + struct.unpack('>H', data[:2])[0]].decode()
+                    with self.lock:
+                        targets = [client for client, client_filters in self.clients
+                                   if any(paho_mqtt.topic_matches_sub(topic_filter, topic) for topic_filter in client_filters)]
+                    for target in targets:
+                        target.sendall(self.packet(0x30, data))
+                elif kind == 12:         # PINGREQ
+                    connection.sendall(self.packet(0xd0, b''))
+        except OSError:
+            pass
+        with self.lock:
+            self.clients[:] = [client for client in self.clients if client[0] is not connection]
+        connection.close()
+
+
+# The MQTT Connector's side: per (broker, message type) queues for fetchQueuedMessage
+class Connector:
+    def __init__(self) -> None:
+        self.queues: dict[tuple[int, str], list[dict]] = {}
+
+    def isEnabled(self):
+        return True
+
+    def executeAction(self, action, deviceId=None, props=None, waitUntilDone=True):
+        if action == "fetchQueuedMessage":
+            queue = self.queues.get((deviceId, props['message_type']), [])
+            return queue.pop(0) if queue else None
+        return None
+
+    def queue(self, brokerID: int, topic: str, payload: dict) -> None:
+        self.queues.setdefault((brokerID, 'mt'), []).append({'topic_parts': topic.split('/'), 'payload': json.dumps(payload)})
+
+
+class Broker:
+    def __init__(self, brokerID: int, props: dict) -> None:
+        self.id = brokerID
+        self.name = f"broker {brokerID}"
+        self.pluginProps = props
+
+
+def wait_for(condition, seconds: float = 5.0) -> bool:
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def main() -> int:
+    broker = MiniBroker()
+    connector = Connector()
+    indigo, plugin_module, plugin = load_plugin({"directMQTT": True, "logLevel": "20"}, connector)
+    if not plugin_module.PAHO_AVAILABLE:
+        print("paho-mqtt unavailable")
+        return 1
+
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append((record.levelno, record.getMessage()))
+
+    plugin.logger.addHandler(Capture())
+    failures = []
+
+    def check(label: str, ok: bool) -> None:
+        print(f"{'ok  ' if ok else 'FAIL'} {label}")
+        if not ok:
+            failures.append(label)
+
+    def logged(level: int, text: str) -> int:
+        return sum(1 for levelno, message in records if levelno == level and text in message)
+
+    def shim(deviceID: int, brokerID: int, **props) -> Device:
+        base = {'brokerID': str(brokerID), 'message_type': 'mt', 'uid_location': 'topic', 'uid_location_topic_field': '1',
+                'state_location': 'payload', 'state_location_payload_type': 'json', 'state_location_payload_key': 'v',
+                'shimSensorSubtype': 'Generic'}
+        base.update(props)
+        device = indigo.devices[deviceID] = Device(deviceID, 'shimValueSensor', base, indigo)
+        return device
+
+    def values(device: Device) -> list:
+        return [value for key, value, _ in device.writes if key == 'sensorValue']
+
+    indigo.devices[1] = Broker(1, {'address': '127.0.0.1', 'port': str(broker.port)})
+    indigo.devices[2] = Broker(2, {'address': '127.0.0.1', 'port': str(broker.port), 'useTLS': True})
+    plugin.pluginPrefs["directMQTTCACerts"] = "/nonexistent/ca.pem"
+    publisher = None
+    try:
+        plugin.startup()
+        direct = shim(10, 1, uid_location='pattern', uid_location_topic_pattern='direct/+uid', address='A')
+        connector_only = shim(11, 1, address='B')
+        plugin.deviceStartComm(direct)
+        plugin.deviceStartComm(connector_only)
+
+        # nothing is listening yet: one error, however many times paho retries
+        time.sleep(2.5)
+        check("connect failure logged once", logged(logging.ERROR, "direct connection to 127.0.0.1") == 1)
+        broker.start()
+        check("connect logged once the broker is up", wait_for(lambda: logged(logging.INFO, "connected directly to") == 1))
+        check("pattern shim subscribed", wait_for(lambda: broker.filters() == ['direct/+']))
+
+        publisher = paho_mqtt.Client(paho_mqtt.CallbackAPIVersion.VERSION2)
+        publisher.connect('127.0.0.1', broker.port)
+        publisher.loop_start()
+        publisher.publish('direct/A', json.dumps({'v': 5}))
+        check("direct message applied", wait_for(lambda: values(direct) == [5]))
+        connector.queue(1, 'direct/A', {'v': 5})
+        connector.queue(1, 'conn/B', {'v': 7})
+        plugin.message_handler({'message_type': 'mt', 'brokerID': '1'})
+        check("connector-only shim served by the connector", wait_for(lambda: values(connector_only) == [7]))
+        check("connector copy of a direct message skipped", values(direct) == [5] and not connector.queues[(1, 'mt')])
+
+        broker.drop_clients()
+        check("lost connection logged", wait_for(lambda: logged(logging.WARNING, "direct connection to 127.0.0.1") == 1))
+        check("reconnect logged", wait_for(lambda: logged(logging.INFO, "connected directly to") == 2))
+        check("resubscribed after reconnect", wait_for(lambda: 'direct/+' in broker.filters()))
+
+        plugin.deviceStopComm(direct)
+        check("unsubscribed on deviceStopComm", wait_for(lambda: 'direct/+' not in broker.filters()))
+
+        # broker 2 asks for TLS with a CA file that doesn't exist: refused, its shims stay on the connector
+        tls_shim = shim(12, 2, uid_location='pattern', uid_location_topic_pattern='direct/+uid', address='C')
+        plugin.deviceStartComm(tls_shim)
+        check("TLS setup error logged", logged(logging.ERROR, "unable to set up the direct connection") == 1)
+        connector.queue(2, 'direct/C', {'v': 9})
+        plugin.message_handler({'message_type': 'mt', 'brokerID': '2'})
+        check("TLS broker's shim served by the connector", wait_for(lambda: values(tls_shim) == [9]))
+    finally:
+        if publisher:
+            publisher.loop_stop()
+        plugin.shutdown()
+    check("no disconnect warning on shutdown", logged(logging.WARNING, "direct connection to 127.0.0.1") == 1)
+    print(f"{len(failures)} failures")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
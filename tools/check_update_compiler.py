@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Differential check of UpdateCompiler's specialized update functions against the generic update().
+# Random shim props and messages are run through both, and the results, state writes, state images,
+# log messages and props have to come out the same.  Each case runs three ways: plain update() calls,
+# as a JSON value sensor with a ValueBatch (flushed by update() itself when the device reports again,
+# and after the last message), and with decode jobs from submit_decodes() on a stand-in decoder pool that decodes, fails
+# or times out depending on the payload.  Runs outside Indigo, on a minimal stand-in for the indigo
+# module, so re-run it after any change to update() or match_uid():
+#
+#     python3 tools/check_update_compiler.py [--seed N] [--cases N]
+
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import sys
+import time
+
+from indigo_stub import Device, load_plugin
+
+DEVICE_TYPES = ['shimRelay', 'shimDimmer', 'shimColor', 'shimOnOffSensor', 'shimValueSensor', 'shimGeneric']
+MODES = ['plain', 'batch', 'decode']
+
+
+# Stands in for the decoder process pool and its AsyncResults
+class DecoderPool:
+    def terminate(self):
+        pass
+
+
+class DecodeResult:
+    def __init__(self, args: tuple) -> None:
+        self.data = args[2]
+
+    def get(self, timeout=None):
+        if self.data == b'notjson':
+            raise ValueError("undecodable payload")
+        if self.data == b'17':
+            raise multiprocessing.TimeoutError
+        return {'decoded': repr(self.data)[:12], 'length': len(self.data) if self.data else 0}
+
+
+def random_props(rng: random.Random, index: int) -> tuple[str, dict]:
+    props = {'brokerID': '1', 'message_type': 'mt', 'address': f'a{index % 3}',
+             'uid_location': rng.choice(['topic', 'payload', 'pattern', 'bogus']),
+             'uid_location_topic_field': rng.choice(['1', '5', 'x']),
+             'uid_location_payload_key': rng.choice(['id', 'nope']),
+             'uid_location_topic_pattern': rng.choice(['x/+uid', 'x/+uid/#rest', '+a/+b']),
+             'state_location': rng.choice(['topic', 'payload', 'decoder', 'none']),
+             'state_location_topic_field': rng.choice(['2', '9']),
+             'state_location_payload_type': rng.choice(['json', 'raw', 'struct']),
+             'struct_format': '<hh', 'struct_fields': 'a,b',
+             'state_location_payload_key': rng.choice(['v', 'state', 'missing', '']),
+             'shimSensorSubtype': rng.choice(['Generic', 'MotionSensor', 'Power', 'Light', 'Temperature-F', 'bogus']),
+             'value_location_payload_key': 'bri', 'color_value_payload_key': 'color', 'color_temp_payload_key': 'ct',
+             'brightness_scale': rng.choice(['100', '255']), 'color_space': rng.choice(['Indigo', 'HueB']),
+             'battery_payload_key': 'bat', 'energy_payload_key': 'e', 'power_payload_key': 'w'}
+    for key in ['SupportsBatteryLevel', 'SupportsEnergyMeter', 'SupportsEnergyMeterCurPower']:
+        if rng.random() < .5:
+            props[key] = rng.choice([True, False, 'true'])
+    if rng.random() < .4:
+        props['state_on_value'] = rng.choice(['ON', '1'])
+    if rng.random() < .4:
+        props['state_dict_payload_key'] = rng.choice(['multi', 'v', 'none'])
+    if rng.random() < .3:
+        props['adjustmentFunction'] = rng.choice(['x*2', 'x+', 'round(x,1)'])
+    for key in list(props):
+        if rng.random() < .05 and key not in ('address', 'brokerID', 'message_type'):
+            del props[key]
+    return rng.choice(DEVICE_TYPES), props
+
+
+# The device a case runs as in each mode: batching only applies to value sensors, so the batch mode
+# makes the device one that reads its value from the payloads' 'v'
+def mode_device(mode: str, deviceTypeId: str, props: dict) -> tuple[str, dict]:
+    if mode == 'batch':
+        return 'shimValueSensor', dict(props, state_location='payload', state_location_payload_type='json', state_location_payload_key='v')
+    if mode == 'decode':
+        return deviceTypeId, dict(props, custom_decoder='/nonexistent/Decoder.py')
+    return deviceTypeId, props
+
+
+def random_message(rng: random.Random) -> tuple[list[str], str]:
+    topic = rng.choice(['x/a0', 'x/a1/extra', 'x/a2/3/4', 'y', 'x/a0/ON'])
+    payload = rng.choice([json.dumps({'v': rng.choice([1, 0, 'ON', 'off', 2.5, True, 'abc']), 'id': f'a{rng.randint(0, 2)}', 'state': 'ON',
+                                      'bri': rng.choice([50, 'x', None]), 'color': {'x': 0.3, 'y': 0.3} if rng.random() < .5 else None,
+                                      'ct': rng.choice([300, 0, 'q']), 'bat': 90, 'e': 1.5, 'w': 7,
+                                      'multi': rng.choice([{'a': 1, 'b': None}, {}, 5])}),
+                          'notjson', '17', '\x01\x00\x02\x00'])
+    return topic.split('/'), payload
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", type=int, default=400)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    indigo, plugin_module, plugin = load_plugin({"logLevel": "5"})
+    if not plugin.updateCompiler:
+        print("UpdateCompiler unavailable")
+        return 1
+    plugin.set_log_level(5)
+
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append((record.levelno, record.funcName, record.getMessage()))
+
+    plugin.logger.addHandler(Capture())
+
+    pool = DecoderPool()
+    plugin.submit_decode = lambda args: (plugin.decoderPool, DecodeResult(args), args, time.monotonic())
+
+    def run(device: Device, props: dict, messages: list, update, mode: str) -> tuple:
+        device.pluginProps = indigo.Dict(props)
+        device.reset()
+        records.clear()
+        plugin.accumulators.clear()
+        plugin.structLayouts.clear()
+        plugin.topicPatterns.clear()
+        plugin.rollingStats.clear()
+        plugin.decoders.clear()
+        plugin.decoderBackoff.clear()
+        plugin.decoderPool = pool
+        batch = plugin_module.ValueBatch() if mode == 'batch' else None
+        results = []
+        for topic_parts, payload in messages:
+            try:
+                if mode == 'decode':
+                    jobs, matches = plugin.submit_decodes([device], {'topic_parts': topic_parts, 'payload': payload})
+                    results.append(update(plugin, device, topic_parts, payload, jobs.get(device.id), None, matches.get(device.id)))
+                else:
+                    results.append(update(plugin, device, topic_parts, payload, None, batch))
+            except Exception as err:
+                results.append(('exception', type(err).__name__, str(err)))
+        if batch is not None:
+            try:
+                plugin.flush_value_batch(batch)
+            except Exception as err:
+                results.append(('exception', type(err).__name__, str(err)))
+        return results, device.writes, device.images, list(records), sorted(device.pluginProps.items(), key=str)
+
+    mismatches = 0
+    try:
+        for index in range(args.cases):
+            deviceTypeId, props = random_props(rng, index)
+            messages = [random_message(rng) for _ in range(6)]
+            for mode in MODES:
+                mode_type, mode_props = mode_device(mode, deviceTypeId, props)
+                device = indigo.devices[1000 + index] = Device(1000 + index, mode_type, mode_props, indigo)
+                if mode == 'decode':
+                    plugin.decoderProcessDevices.add(device.id)
+                generic = run(device, mode_props, messages, plugin_module.Plugin.update, mode)
+                specialized = run(device, mode_props, messages, plugin.updateCompiler.compile(device), mode)
+                plugin.decoderProcessDevices.discard(device.id)
+                if repr(generic) != repr(specialized):
+                    mismatches += 1
+                    for name, expected, got in zip(['results', 'writes', 'images', 'logs', 'props'], generic, specialized):
+                        if repr(expected) != repr(got):
+                            print(f"MISMATCH {mode_type} {mode} {name} for props {mode_props}\n    generic:     {expected}\n    specialized: {got}")
+    finally:
+        plugin.decoderPool = None
+        plugin.shutdown()
+    print(f"{args.cases} cases x {len(MODES)} modes, {mismatches} mismatches, {len(plugin.updateCompiler.cache)} props shapes compiled")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
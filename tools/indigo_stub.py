@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+####################
+# A minimal stand-in for the indigo module and its devices, so the checks in this folder can load
+# plugin.py and run it outside Indigo.
+
+import builtins
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+import types
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "MQTT Shims.indigoPlugin", "Contents", "Server Plugin")
+
+STATE_IMAGES = ['SensorOn', 'SensorOff', 'MotionSensorTripped', 'MotionSensor', 'PowerOn', 'PowerOff', 'DimmerOn', 'DimmerOff',
+                'EnergyMeterOn', 'LightSensorOn', 'NoImage', 'TemperatureSensor', 'TemperatureSensorOn', 'HumiditySensor', 'HumiditySensorOn']
+
+
+# Just enough of the indigo module for the plugin to load and run update() on fake devices
+def indigo_stub(folder: str, connector=None) -> types.ModuleType:
+    indigo = types.ModuleType("indigo")
+    logging.addLevelName(5, "THREADDEBUG")
+    logging.Logger.threaddebug = lambda self, msg, *args, **kwargs: self.log(5, msg, *args, **kwargs)
+
+    class PluginBase:
+        class StopThread(Exception):
+            pass
+
+        def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+            self.pluginId = pluginId
+            self.pluginVersion = pluginVersion
+            self.pluginPrefs = pluginPrefs
+            self.logger = logging.getLogger("Plugin")
+            self.indigo_log_handler = logging.NullHandler()
+            self.plugin_file_handler = logging.NullHandler()
+            self.logger.addHandler(self.indigo_log_handler)
+            self.logger.addHandler(self.plugin_file_handler)
+            self.logger.setLevel(5)
+
+        def sleep(self, seconds):
+            pass
+
+        def substitute(self, text):
+            return text
+
+        def getDeviceStateList(self, device):
+            return []
+
+    class MQTTConnector:
+        def isEnabled(self):
+            return True
+
+        def executeAction(self, *args, **kwargs):
+            return None
+
+    indigo.PluginBase = PluginBase
+    indigo.Dict = type("Dict", (dict,), {})
+    indigo.List = type("List", (list,), {})
+    indigo.Device = object
+    indigo.kStateImageSel = types.SimpleNamespace(**{name: name for name in STATE_IMAGES})
+    indigo.kDeviceAction = indigo.kUniversalAction = indigo.kProtocol = types.SimpleNamespace()
+    indigo.devices = {}
+    indigo.triggers = {}
+    indigo.trigger = types.SimpleNamespace(execute=lambda trigger: None)
+    indigo.server = types.SimpleNamespace(getPlugin=lambda pluginId: connector or MQTTConnector(),
+                                          getInstallFolderPath=lambda: folder,
+                                          getLogsFolderPath=lambda pluginId=None: folder,
+                                          subscribeToBroadcast=lambda *args: None)
+    return indigo
+
+
+class Device:
+    def __init__(self, deviceID: int, deviceTypeId: str, props: dict, indigo: types.ModuleType) -> None:
+        self.id = deviceID
+        self.name = f"device {deviceID}"
+        self.deviceTypeId = deviceTypeId
+        self.pluginId = "com.flyingdiver.indigoplugin.shims"
+        self.pluginProps = indigo.Dict(props)
+        self.address = props.get('address')
+        self.indigo = indigo
+        self.reset()
+
+    def reset(self) -> None:
+        self.states = {'accumEnergyTotal': 0, 'curEnergyLevel': 0}
+        self.writes = []
+        self.images = []
+
+    def updateStateOnServer(self, key, value, **kwargs):
+        self.states[key] = value
+        self.writes.append((key, value, kwargs))
+
+    def updateStatesOnServer(self, state_list):
+        for state in state_list:
+            self.updateStateOnServer(state['key'], state['value'], **{k: v for k, v in state.items() if k not in ('key', 'value')})
+
+    def updateStateImageOnServer(self, image):
+        self.images.append(image)
+
+    def replacePluginPropsOnServer(self, props):
+        self.pluginProps = self.indigo.Dict(props)
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+
+# Installs the stub as the indigo module, loads plugin.py and returns the module and a Plugin built with prefs
+def load_plugin(prefs: dict, connector=None) -> tuple[types.ModuleType, types.ModuleType, object]:
+    indigo = indigo_stub(tempfile.mkdtemp(), connector)
+    sys.modules["indigo"] = builtins.indigo = indigo
+    sys.path.insert(0, PLUGIN_DIR)
+    spec = importlib.util.spec_from_file_location("plugin", os.path.join(PLUGIN_DIR, "plugin.py"))
+    plugin_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin_module)
+    plugin = plugin_module.Plugin("com.flyingdiver.indigoplugin.shims", "MQTT Shims", "0", indigo.Dict(prefs))
+    return indigo, plugin_module, plugin